@@ -1,94 +1,149 @@
-from PySide6.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QTableWidgetItem,
-                               QPushButton, QFileDialog, QMessageBox, QTableWidget, QHeaderView, QAbstractItemView)
-from PySide6.QtCore import (Qt, Slot, Signal)
+from PySide6.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QTableWidgetItem, QLabel,
+                               QPushButton, QFileDialog, QMessageBox, QTableWidget, QHeaderView, QAbstractItemView,
+                               QProgressBar, QComboBox)
+from PySide6.QtCore import (Qt, Slot, Signal, QTimer, QObject, QRunnable, QThreadPool, QRectF)
 from PySide6.QtGui import QColor
 import numpy as np
 import pyqtgraph
 import sys
 import os
-import glob
-
-
-def str2float(x):
-    try:
-        return float(x)
-    except ValueError:
-        return None
-
-
-def dict_keys_list(x: dict):
-    keys = []
-    for k in x.keys():
-        keys.append(k)
-    keys.sort()
-    return keys
-
-
-def parse_file(file_path):
-    with open(file_path) as fid:
-        lines = fid.readlines()
-    if len(lines) < 3:
-        return []
-    x_values = []
-    y_values = []
-    min_x = 5.8
-    max_x = 7.2
-    for i in range(2, len(lines)):
-        lsp = lines[i].split()
-        if len(lsp) == 3:
-            x = str2float(lsp[0])
-            y = str2float(lsp[1])
-            if x is not None and y is not None:
-                # x_r = round(x, 3)
-                if min_x <= x <= max_x:
-                    x_values.append(x)
-                    y_values.append(y)
-    if len(x_values) > 0 and len(y_values) > 0:
-        return np.array(x_values, dtype=np.float32), np.array(y_values, dtype=np.float32)
-    else:
-        return []
-
-
-def get_file_info(f_name: str):
-    dot_sp = f_name.split(".")
-    if len(dot_sp) != 2 or len(dot_sp[1]) != 3:
-        return []
-    if dot_sp[1][0: 2] != "ra" and dot_sp[1][0: 2] != "ri":
-        return []
-    dash_sp = dot_sp[0].split("-")
-    if len(dash_sp) != 7:
-        return []
-    run_id = dash_sp[0]
-    cell = int(dash_sp[2][1:])
-    scan = int(dash_sp[3][1:])
-    wavelength = int(dash_sp[4][1: 4])
-    return run_id, cell, scan, wavelength
-
-
-def compare_x_array(arr1: np.array, arr2: np.array):
-    len_chk = len(arr1) == len(arr2)
-    i_chk = round(arr1[0], 3) == round(arr2[0], 3)
-    f_chk = round(arr1[-1], 3) == round(arr2[-1], 3)
-    if len_chk and i_chk and f_chk:
-        return True
-    else:
-        return False
+import threading
+import zipfile
+from absorbance_core import (RADIAL_MIN, RADIAL_MAX, MEMORY_LIMIT, REPORT_FORMATS, ScanStore, LazyScanStore,
+                             Workspace, RunWatcher, TableWriter, Cancelled, get_file_info, list_scan_files, load_run,
+                             open_run, scan_files_size, scan_table, apply_regions, update_cell_integrals, write_report,
+                             profiler, is_archive, archive_files, read_archive, store_scans, detect_regions,
+                             read_spectra, fit_spectra, find_outliers, cell_block, OUTLIER_THRESHOLD)
+
+N_WORKERS = None  # number of parser workers, None uses every core
+LAZY_LOADING = None  # parse scans on demand: True, False, or None when the run files outgrow MEMORY_LIMIT
+WATCH_INTERVAL = 2000  # ms between two polls of the run directory in watch mode
+PROFILE_LOG = None  # JSON lines file the stage records are appended to while diagnostics are on
+PROFILE_STAGE = None  # stage run under cProfile while diagnostics are on, e.g. "parse_file"
+PROFILE_MEMORY = False  # diagnostics also trace the peak memory of each stage, which slows the stages down
+INTERVAL_RESAMPLES = 2000  # bootstrap resamples of the confidence intervals
+INTERVAL_LEVEL = 0.95  # coverage of the confidence intervals
+OUTLIER_PROFILES = False  # outlier screening also compares the scan profiles, not only their areas
+FIT_NON_NEGATIVE = True  # component coefficients of the spectral fits are kept >= 0
+ARCHIVE_FILTER = "Archives (*.zip *.tar *.tar.gz *.tgz *.tar.bz2 *.tbz2 *.tar.xz *.txz)"
+RUN_STYLES = [Qt.PenStyle.SolidLine, Qt.PenStyle.DashLine, Qt.PenStyle.DotLine, Qt.PenStyle.DashDotLine,
+              Qt.PenStyle.DashDotDotLine]  # integral line style of each run of a workspace
+
+
+class WorkerSignals(QObject):
+    progress = Signal(int, int)
+    finished = Signal(object)
+    failed = Signal(str)
+    cancelled = Signal()
+
+
+class Worker(QRunnable):
+    # runs func(*args, progress=..., cancel=...) on a pool thread, the outcome comes back through the signals;
+    # progress is only emitted when its percentage changes
+    def __init__(self, func, *args):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.func = func
+        self.args = args
+        self.signals = WorkerSignals()
+        self.cancel = threading.Event()
+        self.percent = -1
+
+    def progress(self, done: int, total: int):
+        percent = 100 * done // max(total, 1)
+        if percent != self.percent:
+            self.percent = percent
+            self.signals.progress.emit(done, total)
+
+    def run(self):
+        try:
+            result = self.func(*self.args, progress=self.progress, cancel=self.cancel)
+        except Cancelled:
+            self.signals.cancelled.emit()
+        except Exception as error:
+            self.signals.failed.emit(str(error))
+        else:
+            self.signals.finished.emit(result)
+
+
+def load_job(directory: str, lazy: bool, multi_run: bool, memory_limit: int, n_workers: int, progress=None,
+             cancel=None):
+    # a directory (or archive) holding several runs is opened as a workspace, archives are never lazy;
+    # multi_run is None for a tar archive, whose runs are only known once it is read
+    with profiler.stage("load_data") as record:
+        if multi_run is None:
+            file_scans = read_archive(directory, n_workers, progress=progress, cancel=cancel)[1]
+            if len({file_scan[0] for file_scan in file_scans if len(file_scan) > 0}) > 1:
+                run_id, absorbance = None, Workspace()
+                absorbance.add_scans(directory, file_scans)
+            else:
+                run_id, absorbance = store_scans(file_scans)
+        elif multi_run:
+            run_id, absorbance = None, Workspace()
+            absorbance.add_directory(directory, n_workers, progress=progress, cancel=cancel)
+        elif lazy and not is_archive(directory):
+            run_id, absorbance = open_run(directory, memory_limit, n_workers)
+        else:
+            run_id, absorbance = load_run(directory, n_workers, progress=progress, cancel=cancel)
+        record["items"] = len(absorbance)
+    return directory, run_id, absorbance
+
+
+def add_run_job(absorbance: ScanStore, run_id: str, directory: str, new_directory: str, n_workers: int,
+                progress=None, cancel=None):
+    # the open run becomes the first run of a new workspace, which is only kept if the new runs load
+    if not isinstance(absorbance, Workspace):
+        workspace = Workspace(absorbance.min_x, absorbance.max_x)
+        workspace.add_store(run_id, directory, absorbance)
+        absorbance = workspace
+    with profiler.stage("load_data") as record:
+        record["items"] = len(absorbance.add_directory(new_directory, n_workers, progress=progress, cancel=cancel))
+    return absorbance
+
+
+def add_files_job(absorbance: LazyScanStore, file_list: list, n_workers: int, progress=None, cancel=None):
+    # new files of a watched lazy run are indexed and parsed here, so showing and trimming them parses nothing
+    abs_ids = absorbance.add_files(file_list, n_workers)
+    absorbance.load(abs_ids)
+    return abs_ids
+
+
+def regions_job(absorbance: ScanStore, progress=None, cancel=None):
+    return detect_regions(absorbance)
+
+
+def scan_table_job(absorbance: ScanStore, cell_minmax: dict, file_name: str, progress=None, cancel=None):
+    with TableWriter(file_name) as writer:
+        writer.write(scan_table(absorbance, cell_minmax))
+    return file_name
 
 
 class MainWindow(QWidget):
+    stage_recorded = Signal(object)  # stage records reach the GUI thread through it
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setMinimumSize(600, 400)
         self.setWindowTitle("Beckman Absorbance Analysis")
-        self.absorbance = list()
-        self.cell_wavelength_scan = dict()
+        self.absorbance = ScanStore()
         self.cell_integral = dict()
+        self.references = None  # (wavelengths, names, spectra) fitted to the integrals
         self.run_id = None
+        self.directory = None
+        self.watcher = None
         self.cell_minmax = dict()
-        self.curve_list = dict()
-        self.cell_last_scans = dict()
+        self.curve_list = list()
+        self.heatmaps = dict()  # current cell key only: wavelengths, grid, abs_ids, rows and scans per wavelength
         self.current_cell = 0
         self.current_wavelengths = list()
+        self.n_workers = N_WORKERS
+        self.lazy = LAZY_LOADING
+        self.memory_limit = MEMORY_LIMIT
+        self.thread_pool = QThreadPool(self)
+        self.thread_pool.setMaxThreadCount(1)
+        self.worker = None
+        self.busy = False
+        self.integral_pending = False
         self.colors = [
             QColor(255, 255, 255),    # White
             QColor(255, 0, 0),        # Red
@@ -105,13 +160,31 @@ class MainWindow(QWidget):
         ]
 
         self.pb_load = QPushButton("Load")
+        self.pb_load_archive = QPushButton("Load Archive")
+        self.pb_load_archive.setToolTip("Load a run from a zip or tar archive without extracting it")
         self.pb_report = QPushButton("Report")
+        self.pb_add_run = QPushButton("Add Run")
+        self.pb_add_run.setToolTip("Add the runs of another directory, to integrate and report them together")
+        self.pb_add_run.setDisabled(True)
+        self.pb_scan_table = QPushButton("Scan Table")
+        self.pb_scan_table.setToolTip("Save the state, region and integral of every scan")
+        self.pb_scan_table.setDisabled(True)
+        self.pb_watch = QPushButton("Watch")
+        self.pb_watch.setCheckable(True)
+        self.pb_watch.setToolTip("Add the scans written to the run directory while it is acquired")
+        self.pb_watch.setDisabled(True)
+        self.watch_timer = QTimer(self)
+        self.watch_timer.setInterval(WATCH_INTERVAL)
 
         lyt_load = QHBoxLayout()
         lyt_load.setContentsMargins(0, 0, 0, 0)
         lyt_load.setSpacing(2)
         lyt_load.addWidget(self.pb_load)
+        lyt_load.addWidget(self.pb_load_archive)
+        lyt_load.addWidget(self.pb_add_run)
         lyt_load.addWidget(self.pb_report)
+        lyt_load.addWidget(self.pb_scan_table)
+        lyt_load.addWidget(self.pb_watch)
         lyt_load.addStretch(1)
 
         self.tw_cell = QTableWidget()
@@ -144,10 +217,23 @@ class MainWindow(QWidget):
         lyt_tables.addWidget(self.tw_lamda)
         lyt_tables.addWidget(self.tw_scan)
 
+        self.pg_progress = QProgressBar()
+        self.pb_cancel = QPushButton("Cancel")
+
+        lyt_progress = QHBoxLayout()
+        lyt_progress.setContentsMargins(0, 0, 0, 0)
+        lyt_progress.setSpacing(2)
+        lyt_progress.addWidget(self.pg_progress, 1)
+        lyt_progress.addWidget(self.pb_cancel)
+        self.wg_progress = QWidget()
+        self.wg_progress.setLayout(lyt_progress)
+        self.wg_progress.setVisible(False)
+
         lyt_left = QVBoxLayout()
         lyt_left.setContentsMargins(0, 0, 0, 0)
         lyt_left.addLayout(lyt_load)
         lyt_left.addLayout(lyt_tables)
+        lyt_left.addWidget(self.wg_progress)
         lyt_left.setSpacing(5)
 
         plt_win = pyqtgraph.GraphicsLayoutWidget()
@@ -160,6 +246,14 @@ class MainWindow(QWidget):
 
         pen = pyqtgraph.mkPen(color='w', width=3)
         self.region_picker = pyqtgraph.LinearRegionItem(pen=pen)
+        self.heatmap_image = pyqtgraph.ImageItem()
+        self.heatmap_image.setColorMap(pyqtgraph.colormap.get("viridis"))
+        pen = pyqtgraph.mkPen(color='w', width=1, style=Qt.PenStyle.DashLine)
+        self.heatmap_lines = [pyqtgraph.InfiniteLine(angle=90, pen=pen), pyqtgraph.InfiniteLine(angle=90, pen=pen)]
+
+        self.pb_heatmap = QPushButton("Heatmap")
+        self.pb_heatmap.setCheckable(True)
+        self.pb_heatmap.setToolTip("Show every scan of the cell as one image row, wavelength by wavelength")
 
         self.pb_region = QPushButton("Set Region")
         self.pb_region.setCheckable(True)
@@ -167,14 +261,56 @@ class MainWindow(QWidget):
         self.pb_region.setMaximumWidth(150)
         self.pb_region.setDisabled(True)
 
+        self.pb_auto_region = QPushButton("Auto Regions")
+        self.pb_auto_region.setToolTip("Propose the region of every cell between its meniscus and its bottom, "
+                                       "they can be adjusted with Set Region")
+        self.pb_auto_region.setDisabled(True)
+
+        self.pb_outliers = QPushButton("Reject Outliers")
+        self.pb_outliers.setToolTip("Uncheck the scans whose integral or profile is an outlier among the scans of "
+                                    "their wavelength")
+        self.pb_outliers.setDisabled(True)
+
         self.pb_integral = QPushButton("Calculate Integral(s)")
         self.pb_integral.setStyleSheet(u"background-color: rgb(249, 240, 107);")
         self.pb_integral.setDisabled(True)
 
+        self.pb_live = QPushButton("Live")
+        self.pb_live.setCheckable(True)
+        self.pb_live.setToolTip("Recalculate the integrals after every scan or region change")
+        self.pb_live.setDisabled(True)
+
+        self.cb_interval = QComboBox()
+        self.cb_interval.addItem("No CI", None)
+        self.cb_interval.addItem("Bootstrap CI", "bootstrap")
+        self.cb_interval.addItem("Jackknife CI", "jackknife")
+        self.cb_interval.setToolTip(f"Confidence interval ({INTERVAL_LEVEL:.0%}) of the integrals, drawn as bands "
+                                    "and added to the report")
+
+        self.pb_fit = QPushButton("Fit Spectra")
+        self.pb_fit.setCheckable(True)
+        self.pb_fit.setToolTip("Fit the integrals as combinations of reference spectra read from a CSV file "
+                               "(wavelength column, then one column per component)")
+
+        self.pb_diagnostics = QPushButton("Diagnostics")
+        self.pb_diagnostics.setCheckable(True)
+        self.pb_diagnostics.setToolTip("Show the time and item count of each processing stage")
+
+        self.lb_status = QLabel()
+        self.lb_status.setWordWrap(True)
+        self.lb_status.setVisible(False)
+
         lyt_reg_int = QHBoxLayout()
         lyt_reg_int.setContentsMargins(0, 0, 0, 0)
         lyt_reg_int.addWidget(self.pb_region)
+        lyt_reg_int.addWidget(self.pb_auto_region)
+        lyt_reg_int.addWidget(self.pb_outliers)
+        lyt_reg_int.addWidget(self.pb_heatmap)
         lyt_reg_int.addStretch(1)
+        lyt_reg_int.addWidget(self.pb_diagnostics)
+        lyt_reg_int.addWidget(self.cb_interval)
+        lyt_reg_int.addWidget(self.pb_fit)
+        lyt_reg_int.addWidget(self.pb_live)
         lyt_reg_int.addWidget(self.pb_integral)
 
         lyt_right = QVBoxLayout()
@@ -182,6 +318,7 @@ class MainWindow(QWidget):
         lyt_right.setSpacing(1)
         lyt_right.addLayout(lyt_reg_int)
         lyt_right.addWidget(plt_win)
+        lyt_right.addWidget(self.lb_status)
 
         lyt_main = QHBoxLayout()
         lyt_main.setContentsMargins(1, 1, 1, 1)
@@ -192,12 +329,26 @@ class MainWindow(QWidget):
         self.setLayout(lyt_main)
 
         self.pb_load.clicked.connect(self.load_data)
+        self.pb_load_archive.clicked.connect(self.load_archive)
+        self.pb_add_run.clicked.connect(self.add_run)
         self.tw_cell.currentItemChanged.connect(self.update_tw_lambda)
         self.tw_lamda.itemSelectionChanged.connect(self.update_tw_scan)
         self.tw_scan.cellClicked.connect(self.update_scan_state)
         self.pb_region.clicked.connect(self.update_region)
+        self.pb_auto_region.clicked.connect(self.auto_regions)
+        self.pb_outliers.clicked.connect(self.reject_outliers)
+        self.pb_heatmap.clicked.connect(self.update_heatmap)
         self.pb_integral.clicked.connect(self.plot_integral)
+        self.pb_live.clicked.connect(self.update_live)
+        self.pb_watch.clicked.connect(self.update_watch)
+        self.watch_timer.timeout.connect(self.poll_run)
         self.pb_report.clicked.connect(self.report)
+        self.pb_scan_table.clicked.connect(self.save_scan_table)
+        self.pb_diagnostics.clicked.connect(self.update_diagnostics)
+        self.stage_recorded.connect(self.show_diagnostics)
+        self.cb_interval.currentIndexChanged.connect(self.update_interval)
+        self.pb_fit.clicked.connect(self.update_fit)
+        self.pb_cancel.clicked.connect(self.cancel_job)
 
     @Slot()
     def load_data(self):
@@ -205,140 +356,260 @@ class MainWindow(QWidget):
                                                      os.path.expanduser('~'), QFileDialog.ShowDirsOnly)
         if len(directory) == 0:
             return
+        self.open_data(directory)
 
-        search_str = os.path.join(directory, "*.ra*")
-        glob_list = glob.glob(search_str)
-        absorbance = []
-        run_id = None
-        for i in range(len(glob_list)):
-            fpath = glob_list[i]
-            file_info = get_file_info(os.path.split(fpath)[1])
-            if len(file_info) == 0:
-                continue
-            file_parsed = parse_file(fpath)
-            if len(file_parsed) == 0:
-                continue
-            run_id_c, cell, scan, wavelength = file_info[0], file_info[1], file_info[2], file_info[3]
-            x_vals, y_vals = file_parsed[0], file_parsed[1]
-            if run_id is None:
-                run_id = run_id_c
-            else:
-                if run_id != run_id_c:
-                    QMessageBox.warning(self, "Error!", f"More than one run ID found:\n{self.run_id}\n{run_id}")
-                    return
-            abs_data = dict()
-            abs_data["x_values"] = x_vals
-            abs_data["y_values"] = y_vals
-            abs_data["cell"] = cell
-            abs_data["wavelength"] = wavelength
-            abs_data["scan"] = scan
-            abs_data["state"] = True
-            abs_data["min_id"] = 0
-            abs_data["max_id"] = np.size(x_vals)
-            absorbance.append(abs_data)
+    @Slot()
+    def load_archive(self):
+        archive = QFileDialog.getOpenFileName(self, "Select Archive", os.path.expanduser('~'), ARCHIVE_FILTER)[0]
+        if len(archive) == 0:
+            return
+        self.open_data(archive)
+
+    def open_data(self, directory: str):
+        # the cells are listed from the file names while the scans are parsed, except for tar archives: listing
+        # them decompresses the whole archive, so it is only read once, by the job
+        if is_archive(directory) and not zipfile.is_zipfile(directory):
+            self.set_tw_cell(cell_list=[])
+            self.start_job(self.loaded, load_job, directory, False, None, self.memory_limit, self.n_workers)
+            return
+        if is_archive(directory):
+            lazy = False
+            file_list = archive_files(directory)
+        else:
+            lazy = self.lazy
+            if lazy is None:
+                lazy = scan_files_size(directory) > self.memory_limit
+            file_list = list_scan_files(directory)
+        file_info = [get_file_info(os.path.split(fpath)[1]) for fpath in file_list]
+        self.set_tw_cell(cell_list=sorted({info[1] for info in file_info}))
+        multi_run = len({info[0] for info in file_info}) > 1
+        self.start_job(self.loaded, load_job, directory, lazy, multi_run, self.memory_limit, self.n_workers)
 
+    @Slot(object)
+    def loaded(self, result):
+        directory, run_id, absorbance = result
         if len(absorbance) == 0:
             QMessageBox.warning(self, "Warning!", "No 'RA' files found!")
+            self.set_tw_cell()
             return
         self.clear_data()
         self.run_id = run_id
+        self.directory = directory
         self.absorbance = absorbance
-        for abs_id in range(len(absorbance)):
-            abs_data = absorbance[abs_id]
-            cell = abs_data.get("cell")
-            wavelength = abs_data.get("wavelength")
-            scan = abs_data.get("scan")
-            wavelength_scan_list = self.cell_wavelength_scan.get(cell)
-            if wavelength_scan_list is None:
-                wavelength_scan_list = dict()
-            scan_list = wavelength_scan_list.get(wavelength)
-            if scan_list is None:
-                scan_list = dict()
-            scan_list[scan] = abs_id
-            wavelength_scan_list[wavelength] = scan_list
-            self.cell_wavelength_scan[cell] = wavelength_scan_list
-            self.absorbance.append(abs_data)
-
-        for cell, wavelength_scan in self.cell_wavelength_scan.items():
+
+        for cell in self.absorbance.cell_keys():
             self.cell_minmax[cell] = [None, None]
             self.cell_integral[cell] = None
 
-            last_scans = []
-            for wavelength, scan in wavelength_scan.items():
-                last_key = -100
-                for key in scan.keys():
-                    last_key = max(key, last_key)
-                last_scans.append(scan.get(last_key))
-            self.cell_last_scans[cell] = last_scans
-
         self.pb_region.setEnabled(True)
+        self.pb_auto_region.setEnabled(True)
+        self.pb_outliers.setEnabled(True)
         self.pb_integral.setEnabled(True)
+        self.pb_live.setEnabled(True)
+        self.pb_watch.setEnabled(not isinstance(self.absorbance, Workspace) and os.path.isdir(directory))
+        self.pb_add_run.setEnabled(True)
+        self.pb_scan_table.setEnabled(True)
         self.set_tw_cell()
 
+    @Slot()
+    def add_run(self):
+        directory = QFileDialog.getExistingDirectory(self, "Select Directory",
+                                                     os.path.expanduser('~'), QFileDialog.ShowDirsOnly)
+        if len(directory) == 0:
+            return
+        self.start_job(self.run_added, add_run_job, self.absorbance, self.run_id, self.directory, directory,
+                       self.n_workers)
+
+    @Slot(object)
+    def run_added(self, workspace):
+        # keys of a single run become (0, cell)
+        if not isinstance(self.absorbance, Workspace):
+            self.pb_watch.setChecked(False)
+            self.update_watch(False)
+            self.cell_minmax = {(0, cell): region for cell, region in self.cell_minmax.items()}
+            self.cell_integral = {(0, cell): val for cell, val in self.cell_integral.items()}
+            self.current_cell = (0, self.current_cell)
+        self.absorbance = workspace
+        self.heatmaps.clear()
+        for cell in workspace.cell_keys():
+            if cell not in self.cell_minmax:
+                self.cell_minmax[cell] = [None, None]
+                self.cell_integral[cell] = None
+        self.pb_watch.setEnabled(False)
+        self.set_tw_cell(keep_current=True)
+        if self.pb_live.isChecked():
+            self.plot_integral()
+
+    def start_job(self, on_finished, func, *args):
+        # one background job at a time, the controls that read or change the scans wait for it;
+        # the previous worker is kept until its run() has returned
+        self.thread_pool.waitForDone()
+        self.worker = Worker(func, *args)
+        self.worker.signals.progress.connect(self.update_progress)
+        self.worker.signals.finished.connect(self.end_job)
+        self.worker.signals.finished.connect(on_finished)
+        self.worker.signals.failed.connect(self.end_job)
+        self.worker.signals.failed.connect(self.job_failed)
+        self.worker.signals.cancelled.connect(self.end_job)
+        self.worker.signals.cancelled.connect(self.job_cancelled)
+        self.pg_progress.setRange(0, 0)
+        self.wg_progress.setVisible(True)
+        self.pb_cancel.setEnabled(True)
+        self.set_busy(True)
+        self.thread_pool.start(self.worker)
+
+    def set_busy(self, busy: bool):
+        # the region picker keeps loading, the scan selection and the automatic changes of the scans locked
+        self.busy = busy
+        loaded = len(self.absorbance) > 0
+        picking = self.pb_region.isChecked()
+        for widget in [self.pb_heatmap, self.tw_cell]:
+            widget.setDisabled(busy)
+        for widget in [self.pb_load, self.pb_load_archive, self.pb_report, self.tw_lamda, self.tw_scan]:
+            widget.setDisabled(busy or picking)
+        for widget in [self.pb_add_run, self.pb_scan_table, self.pb_region, self.pb_integral]:
+            widget.setEnabled(loaded and not busy)
+        for widget in [self.pb_auto_region, self.pb_outliers]:
+            widget.setEnabled(loaded and not busy and not picking)
+        self.pb_watch.setEnabled(loaded and not busy and not isinstance(self.absorbance, Workspace) and
+                                 os.path.isdir(self.directory))
+
+    @Slot(int, int)
+    def update_progress(self, done, total):
+        self.pg_progress.setRange(0, total)
+        self.pg_progress.setValue(done)
+
+    @Slot()
+    def cancel_job(self):
+        if self.busy:
+            self.worker.cancel.set()
+            self.pb_cancel.setDisabled(True)
+
+    @Slot()
+    def end_job(self):
+        self.wg_progress.setVisible(False)
+        self.set_busy(False)
+        if self.integral_pending:
+            self.integral_pending = False
+            self.plot_integral()
+
+    @Slot(str)
+    def job_failed(self, message):
+        self.set_tw_cell(keep_current=True)
+        QMessageBox.warning(self, "Error!", message)
+
+    @Slot()
+    def job_cancelled(self):
+        self.set_tw_cell(keep_current=True)
+
+    def closeEvent(self, event):
+        if self.busy:
+            self.worker.cancel.set()
+        self.thread_pool.waitForDone()
+        super().closeEvent(event)
+
+    @Slot(bool)
+    def update_watch(self, checked):
+        if checked:
+            self.watcher = RunWatcher(self.directory, self.run_id, seen=self.absorbance.files)
+            self.watch_timer.start()
+        else:
+            self.watch_timer.stop()
+            self.watcher = None
+
+    @Slot()
+    def poll_run(self):
+        # the new scans of a lazy run are parsed in the background
+        if self.watcher is None or self.pb_region.isChecked() or self.busy:
+            return
+        try:
+            file_list = self.watcher.poll()
+            if len(file_list) > 0 and isinstance(self.absorbance, LazyScanStore):
+                self.start_job(self.scans_added, add_files_job, self.absorbance, file_list, self.n_workers)
+                return
+            abs_ids = self.absorbance.add_files(file_list, self.n_workers)
+        except (OSError, ValueError) as error:
+            self.pb_watch.setChecked(False)
+            self.update_watch(False)
+            QMessageBox.warning(self, "Error!", str(error))
+            return
+        self.scans_added(abs_ids)
+
+    @Slot(object)
+    def scans_added(self, abs_ids):
+        if len(abs_ids) > 0:
+            self.add_scans(abs_ids)
+
+    def add_scans(self, abs_ids):
+        # apply the regions to newly acquired scans and refresh only the views they touch
+        store = self.absorbance
+        new_cells = False
+        for cell in np.unique(store.cell[abs_ids]).tolist():
+            if cell not in self.cell_minmax:
+                new_cells = True
+                self.cell_minmax[cell] = [None, None]
+                self.cell_integral[cell] = None
+        apply_regions(store, self.cell_minmax, abs_ids)
+        for cell in np.unique(store.cell[abs_ids]).tolist():
+            self.heatmaps.pop(cell, None)
+        if new_cells:
+            self.set_tw_cell(keep_current=True)
+        cell_ids = abs_ids[store.cell[abs_ids] == self.current_cell]
+        if len(cell_ids) > 0:
+            if len(store.wavelengths(self.current_cell)) != self.tw_lamda.rowCount():
+                self.set_tw_lambda(keep_selection=True)
+            if np.any(np.isin(store.wavelength[cell_ids], self.current_wavelengths)):
+                self.update_tw_scan()
+            elif self.pb_heatmap.isChecked():
+                self.plot_scans()
+        if self.pb_live.isChecked():
+            self.plot_integral()
+
     @Slot()
     def report(self):
-        cell_list = []
-        data_list = []
-        n_row_list = []
-        for key, val in self.cell_integral.items():
-            if val is None:
-                continue
-            cell_list.append(key)
-            data_list.append(val)
-            n_row_list.append(len(val[0]))
-        n_cell = len(cell_list)
+        n_cell = len([val for val in self.cell_integral.values() if val is not None])
         if n_cell == 0:
             QMessageBox.warning(self, "Warning", "Integral profiles not found!")
             return
-        ft = QFileDialog.getSaveFileName(self, "Save CSV File", os.path.expanduser('~'), "*.csv")
+        file_name = self.get_report_name("Save Report")
+        if file_name is None:
+            return
+        write_report(file_name, self.cell_integral, self.absorbance.report_labels())
+
+    @Slot()
+    def save_scan_table(self):
+        # the scans of a lazy run are all parsed for their integrals, in the background
+        file_name = self.get_report_name("Save Scan Table")
+        if file_name is None:
+            return
+        if isinstance(self.absorbance, LazyScanStore):
+            self.start_job(lambda _: None, scan_table_job, self.absorbance, self.cell_minmax, file_name)
+        else:
+            scan_table_job(self.absorbance, self.cell_minmax, file_name)
+
+    def get_report_name(self, caption: str):
+        filters = {f"{name} (*{ext})": ext for ext, name in REPORT_FORMATS.items()}
+        ft = QFileDialog.getSaveFileName(self, caption, os.path.expanduser('~'), ";;".join(filters))
         file_name = ft[0]
         if len(file_name) == 0:
-            return
+            return None
 
         temp_name = file_name.lower()
-        if not temp_name.endswith(".csv"):
-            file_name += ".csv"
-        header = True
-        with open(file_name, 'w') as fid:
-            row = 0
-            while True:
-                if header:
-                    line = ""
-                    for i in range(n_cell):
-                        line += f"Cell_{cell_list[i]}_lambda,Cell_{cell_list[i]}_OD,"
-                        line += f"Cell_{cell_list[i]}_STD"
-                        if i == n_cell - 1:
-                            line += "\n"
-                        else:
-                            line += ","
-                    header = False
-                    fid.write(line)
-                has_data = False
-                line = ""
-                for i in range(n_cell):
-                    if row >= n_row_list[i]:
-                        has_data = has_data or False
-                        line += ",,"
-                    else:
-                        has_data = has_data or True
-                        data = data_list[i]
-                        line += f"{data[0][row]},{data[1][row]:.8f},{data[2][row]:.8f}"
-                    if i == n_cell - 1:
-                        line += "\n"
-                    else:
-                        line += ","
-                if has_data:
-                    fid.write(line)
-                    row += 1
-                else:
-                    break
+        if os.path.splitext(temp_name)[1] not in REPORT_FORMATS:
+            file_name += filters.get(ft[1], ".csv")
+        return file_name
 
     @Slot(object, object)
     def update_tw_lambda(self, c_item, p_item):
-        cell = int(c_item.text())
+        cell = c_item.data(Qt.ItemDataRole.UserRole)
+        if cell is None:
+            return
         self.current_cell = cell
         self.current_wavelengths.clear()
-        wavelength_list = dict_keys_list(self.cell_wavelength_scan.get(cell))
+        self.set_tw_lambda()
+
+    def set_tw_lambda(self, keep_selection: bool = False):
+        wavelength_list = self.absorbance.wavelengths(self.current_cell).tolist()
         self.tw_lamda.itemSelectionChanged.disconnect(self.update_tw_scan)
         self.tw_lamda.clear()
         self.tw_lamda.setRowCount(len(wavelength_list))
@@ -346,10 +617,12 @@ class MainWindow(QWidget):
             item = QTableWidgetItem(str(wavelength_list[i]))
             item.setFlags(item.flags() & ~Qt.ItemFlag.ItemIsEditable)
             self.tw_lamda.setItem(i, 0, item)
+            if keep_selection and wavelength_list[i] in self.current_wavelengths:
+                item.setSelected(True)
         self.tw_lamda.setHorizontalHeaderLabels(["Lambda"])
         self.tw_lamda.verticalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
         self.tw_lamda.itemSelectionChanged.connect(self.update_tw_scan)
-        if len(wavelength_list) > 0:
+        if not keep_selection and len(wavelength_list) > 0:
             self.tw_lamda.setCurrentCell(0, 0)
             self.tw_lamda.setCurrentItem(self.tw_lamda.item(0, 0))
 
@@ -360,23 +633,19 @@ class MainWindow(QWidget):
         self.current_wavelengths = wavelength_list
         if len(wavelength_list) == 1:
             wavelength = int(wavelength_list[0])
-            scan_list = dict_keys_list(self.cell_wavelength_scan.get(cell).get(wavelength))
+            scan_ids = self.absorbance.scan_ids(cell, wavelength)
             self.tw_scan.cellClicked.disconnect(self.update_scan_state)
             self.tw_scan.clear()
-            self.tw_scan.setRowCount(len(scan_list))
-            row = 0
-            scan_dict = self.cell_wavelength_scan.get(cell).get(wavelength)
-            for i in range(len(scan_list)):
-                abs_id = scan_dict.get(scan_list[i])
-                state = self.absorbance[abs_id].get("state")
-                item = QTableWidgetItem(str(scan_list[i]))
+            self.tw_scan.setRowCount(len(scan_ids))
+            for row, abs_id in enumerate(scan_ids.tolist()):
+                item = QTableWidgetItem(str(self.absorbance.scan[abs_id]))
+                item.setData(Qt.ItemDataRole.UserRole, abs_id)
                 item.setFlags(Qt.ItemFlag.ItemIsUserCheckable | Qt.ItemFlag.ItemIsEnabled)
-                if state:
+                if self.absorbance.state[abs_id]:
                     item.setCheckState(Qt.CheckState.Checked)
                 else:
                     item.setCheckState(Qt.CheckState.Unchecked)
                 self.tw_scan.setItem(row, 0, item)
-                row += 1
             self.tw_scan.setHorizontalHeaderLabels(["Scan"])
             self.tw_scan.verticalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
             self.tw_scan.cellClicked.connect(self.update_scan_state)
@@ -391,16 +660,17 @@ class MainWindow(QWidget):
 
     @Slot(int, int)
     def update_scan_state(self, row, col):
-        cell = self.current_cell
-        wavelength = self.current_wavelengths[0]
         item = self.tw_scan.item(row, col)
-        scan = int(item.text())
-        abs_id = self.cell_wavelength_scan.get(cell).get(wavelength).get(scan)
-        if item.checkState() == Qt.CheckState.Checked:
-            self.absorbance[abs_id]["state"] = True
-        else:
-            self.absorbance[abs_id]["state"] = False
+        abs_id = item.data(Qt.ItemDataRole.UserRole)
+        self.absorbance.set_state(abs_id, item.checkState() == Qt.CheckState.Checked)
         self.plot_scans()
+        if self.pb_live.isChecked():
+            self.plot_integral()
+
+    @Slot(bool)
+    def update_live(self, checked):
+        if checked:
+            self.plot_integral()
 
     @Slot(bool)
     def update_region(self, checked):
@@ -408,147 +678,321 @@ class MainWindow(QWidget):
             self.pb_region.setText("Apply")
             self.pb_region.setStyleSheet(u"background-color: rgb(143, 240, 164);")
             self.pick_region(1)
-            self.pb_load.setDisabled(True)
-            self.pb_report.setDisabled(True)
-            self.tw_scan.setDisabled(True)
-            self.tw_lamda.setDisabled(True)
-            self.tw_scan.setDisabled(True)
         else:
             self.pb_region.setText("Set Region")
             self.pb_region.setStyleSheet(u"background-color: rgb(249, 240, 107);")
             self.pick_region(0)
-            self.pb_load.setEnabled(True)
-            self.pb_report.setEnabled(True)
-            self.tw_scan.setEnabled(True)
-            self.tw_lamda.setEnabled(True)
-            self.tw_scan.setEnabled(True)
+        self.set_busy(self.busy)
+
+    @Slot()
+    def auto_regions(self):
+        # the last scans of a lazy run may have to be parsed, so its regions are found in the background
+        if isinstance(self.absorbance, LazyScanStore):
+            self.start_job(self.regions_found, regions_job, self.absorbance)
+        else:
+            self.regions_found(regions_job(self.absorbance))
+
+    @Slot(object)
+    def regions_found(self, regions):
+        # the proposed regions replace those of every cell where one is found
+        if len(regions) == 0:
+            QMessageBox.warning(self, "Warning!", "No region found!")
+            return
+        self.cell_minmax.update(regions)
+        apply_regions(self.absorbance, regions)
+        self.plot_scans()
+        if self.pb_live.isChecked():
+            self.plot_integral()
+
+    @Slot()
+    def reject_outliers(self):
+        # lazy runs are screened in the background since their scans may have to be parsed
+        if isinstance(self.absorbance, LazyScanStore):
+            self.start_job(self.outliers_found, find_outliers, self.absorbance, None, OUTLIER_THRESHOLD,
+                           OUTLIER_PROFILES)
+        else:
+            self.outliers_found(find_outliers(self.absorbance, None, OUTLIER_THRESHOLD, OUTLIER_PROFILES))
+
+    @Slot(object)
+    def outliers_found(self, result):
+        # the outliers are unchecked and listed with their scores for review
+        abs_ids, area_scores, profile_scores = result
+        if len(abs_ids) == 0:
+            QMessageBox.information(self, "Outliers", "No outlier scan found.")
+            return
+        self.absorbance.set_state(abs_ids, False)
+        lines = []
+        for abs_id, code, area_score, profile_score in zip(abs_ids.tolist(),
+                                                           self.absorbance.scan_codes(abs_ids).tolist(),
+                                                           area_scores.tolist(), profile_scores.tolist()):
+            line = (f"Cell {self.absorbance.cell_name(self.absorbance.code_key(code))}, "
+                    f"{self.absorbance.wavelength[abs_id]} nm, scan {self.absorbance.scan[abs_id]}: "
+                    f"area score {area_score:.1f}")
+            if not np.isnan(profile_score):
+                line += f", profile score {profile_score:.1f}"
+            lines.append(line)
+        self.update_tw_scan()
+        if self.pb_live.isChecked():
+            self.plot_integral()
+        summary = QMessageBox(QMessageBox.Icon.Information, "Outliers", f"{len(abs_ids)} outlier scans unchecked.",
+                              parent=self)
+        summary.setDetailedText("\n".join(lines))
+        summary.exec()
 
     @Slot()
     def plot_integral(self):
-        self.figure_area.clear()
-        self.figure_area.addLegend()
-        counter = -1
-        for cell in self.cell_wavelength_scan.keys():
-            counter += 1
-            [min_x, max_x] = self.cell_minmax.get(cell)
-            if min_x is None or max_x is None:
-                continue
-            wavelength_vec = []
-            integral_vec = []
-            std_vec = []
-            for wavelength in self.cell_wavelength_scan.get(cell).keys():
-                int_list = []
-                for abs_id in self.cell_wavelength_scan.get(cell).get(wavelength).values():
-                    abs_data = self.absorbance[abs_id]
-                    state = abs_data.get("state")
-                    if not state:
-                        continue
-                    x_val = abs_data.get("x_values")
-                    y_val = abs_data.get("y_values")
-                    min_id = abs_data.get("min_id")
-                    max_id = abs_data.get("max_id")
-                    area = np.trapz(y_val[min_id: max_id], x_val[min_id: max_id])
-                    int_list.append(area)
-                if len(int_list) == 0:
+        # only the groups touched since the last call are integrated again; lazy runs (whose scans may have to be
+        # parsed) and confidence intervals (thousands of resamples per group) are computed in the background
+        if self.busy:
+            self.integral_pending = True
+            return
+        interval = None
+        if self.cb_interval.currentData() is not None:
+            interval = {"method": self.cb_interval.currentData(), "n_resamples": INTERVAL_RESAMPLES,
+                        "level": INTERVAL_LEVEL}
+        if interval is not None or isinstance(self.absorbance, LazyScanStore):
+            self.start_job(self.draw_integral, update_cell_integrals, self.absorbance, self.cell_minmax,
+                           self.cell_integral, interval)
+        else:
+            self.draw_integral(update_cell_integrals(self.absorbance, self.cell_minmax, self.cell_integral,
+                                                     interval))
+
+    @Slot(bool)
+    def update_fit(self, checked):
+        self.references = None
+        if checked:
+            file_name = QFileDialog.getOpenFileName(self, "Select Reference Spectra", os.path.expanduser('~'),
+                                                    "CSV (*.csv)")[0]
+            try:
+                if len(file_name) > 0:
+                    self.references = read_spectra(file_name)
+            except (OSError, ValueError) as error:
+                QMessageBox.warning(self, "Warning!", f"Failed to read the reference spectra:\n{error}")
+            self.pb_fit.setChecked(self.references is not None)
+        if self.pb_integral.isEnabled():
+            self.plot_integral()
+
+    @Slot(int)
+    def update_interval(self, index):
+        # the intervals of every cell are computed again with the new method
+        if self.pb_integral.isEnabled():
+            self.plot_integral()
+
+    @Slot(object)
+    def draw_integral(self, region_cells):
+        with profiler.stage("plot_integral", len(region_cells)):
+            self.figure_area.clear()
+            self.figure_area.addLegend()
+            # the runs of a workspace are overlaid, each cell number keeps its color and each run its line style
+            cell_numbers = self.absorbance.cells().tolist()
+            colors = dict()
+            for cell in self.absorbance.cell_keys():
+                cell_integral = self.cell_integral.get(cell)
+                if cell not in region_cells or cell_integral is None:
                     continue
-                wavelength_vec.append(wavelength)
-                int_list = np.array(int_list, dtype=np.float32)
-                integral_vec.append(np.mean(int_list))
-                std_vec.append(np.std(int_list))
+                counter = cell_numbers.index(cell[1] if isinstance(cell, tuple) else cell)
+                colors[cell] = self.colors[counter % len(self.colors)]
+                pen = pyqtgraph.mkPen(color=colors[cell], width=2)
+                if isinstance(cell, tuple):
+                    pen.setStyle(RUN_STYLES[cell[0] % len(RUN_STYLES)])
+                self.figure_area.plot(cell_integral[0], cell_integral[1], pen=pen,
+                                      name=self.absorbance.cell_name(cell))
+                if len(cell_integral) == 5:
+                    # groups without an interval close the band at their mean
+                    low = np.where(np.isnan(cell_integral[3]), cell_integral[1], cell_integral[3])
+                    high = np.where(np.isnan(cell_integral[4]), cell_integral[1], cell_integral[4])
+                    color = QColor(self.colors[counter % len(self.colors)])
+                    color.setAlpha(60)
+                    band = pyqtgraph.FillBetweenItem(pyqtgraph.PlotCurveItem(cell_integral[0], low),
+                                                     pyqtgraph.PlotCurveItem(cell_integral[0], high), brush=color)
+                    self.figure_area.addItem(band)
+            if self.references is not None:
+                self.draw_fits({cell: self.cell_integral[cell] for cell in colors}, colors)
 
-            if len(wavelength_vec) == 0:
-                self.cell_integral[cell] = None
-                continue
-            wavelength_vec = np.array(wavelength_vec, dtype=np.float32)
-            integral_vec = np.array(integral_vec, dtype=np.float32)
-            std_vec = np.array(std_vec, dtype=np.float32)
-            argsort = np.argsort(wavelength_vec)
-            cell_integral = list()
-            wavelength_vec = wavelength_vec[argsort]
-            integral_vec = integral_vec[argsort]
-            std_vec = std_vec[argsort]
-            cell_integral.append(wavelength_vec)
-            cell_integral.append(integral_vec)
-            cell_integral.append(std_vec)
-            self.cell_integral[cell] = cell_integral
-
-            pen = pyqtgraph.mkPen(color=self.colors[counter % len(self.colors)], width=2)
-            self.figure_area.plot(wavelength_vec, integral_vec, pen=pen, name=str(cell))
+    def draw_fits(self, cell_integral, colors):
+        # fitted spectra dashed with their coefficients in the legend, residuals as crosses around zero
+        wavelengths, names, spectra = self.references
+        cell_fit = fit_spectra(cell_integral, wavelengths, spectra, FIT_NON_NEGATIVE)
+        for cell, (coefficients, fitted, residuals) in cell_fit.items():
+            text = ", ".join(f"{name} {value:.4g}" for name, value in zip(names, coefficients))
+            pen = pyqtgraph.mkPen(color=colors[cell], width=1, style=Qt.PenStyle.DashLine)
+            self.figure_area.plot(cell_integral[cell][0], fitted, pen=pen, connect="finite",
+                                  name=f"{self.absorbance.cell_name(cell)} fit: {text}")
+            self.figure_area.plot(cell_integral[cell][0], residuals, pen=None, symbol="x", symbolSize=5,
+                                  symbolPen=colors[cell], symbolBrush=None)
+
+    @Slot(bool)
+    def update_diagnostics(self, checked):
+        profiler.configure(checked, trace_memory=PROFILE_MEMORY, log_file=PROFILE_LOG, profile_stage=PROFILE_STAGE)
+        if checked:
+            profiler.listeners.append(self.emit_record)
+        elif self.emit_record in profiler.listeners:
+            profiler.listeners.remove(self.emit_record)
+        profiler.clear()
+        self.lb_status.clear()
+        self.lb_status.setVisible(checked)
+
+    def emit_record(self, record):
+        # profiler listener, called in the thread of the stage (often a worker)
+        self.stage_recorded.emit(record)
+
+    @Slot(object)
+    def show_diagnostics(self, record):
+        # latest record of each stage, the most recent last
+        text = []
+        for stage in profiler.snapshot():
+            line = f"{stage['stage']}: {stage['seconds'] * 1e3:.1f} ms"
+            if stage["items"] > 0:
+                line += f", {stage['items']} items"
+            if stage["peak_bytes"] is not None:
+                line += f", {stage['peak_bytes'] / 2 ** 20:.1f} MB"
+            text.append(line)
+        self.lb_status.setText(" | ".join(text))
 
     def clear_data(self):
+        self.pb_watch.setChecked(False)
+        self.update_watch(False)
         self.absorbance.clear()
-        self.cell_wavelength_scan.clear()
         self.cell_integral.clear()
         self.run_id = None
         self.cell_minmax.clear()
+        self.figure_scans.clear()
         self.curve_list.clear()
-        self.cell_last_scans.clear()
+        self.heatmaps.clear()
         self.current_cell = 0
         self.current_wavelengths.clear()
 
     def plot_last_scans(self):
+        if self.pb_heatmap.isChecked():
+            self.plot_heatmap()
+            return
         cell = self.current_cell
-        last_scans = self.cell_last_scans.get(cell)
-        self.figure_scans.clear()
+        last_scans = self.absorbance.last_scans(cell)
+        self.absorbance.load(last_scans)
+        self.figure_scans.setTitle(title=f"Cell {self.absorbance.cell_name(cell)}")
         pen = pyqtgraph.mkPen(color='yellow', width=1)
-        for abs_id in last_scans:
-            abs_data = self.absorbance[abs_id]
-            min_id = abs_data.get("min_id")
-            max_id = abs_data.get("max_id")
-            x_vals = abs_data.get("x_values")[min_id: max_id]
-            y_vals = abs_data.get("y_values")[min_id: max_id]
-            cell = abs_data.get("cell")
-            self.figure_scans.setTitle(title=f"Cell {cell}")
-            curve = self.figure_scans.plot(pen=pen)
-            curve.setData(x_vals, y_vals)
+        self.show_curves(last_scans, pen)
 
     def plot_scans(self):
-        self.figure_scans.clear()
+        if self.pb_heatmap.isChecked():
+            self.plot_heatmap()
+            return
         cell = self.current_cell
         wavelength_keys = self.current_wavelengths
         if len(wavelength_keys) == 0:
             self.figure_scans.setTitle(title="")
+            self.show_curves([], None)
             return
         elif len(wavelength_keys) == 1:
-            flag_title = "SINGLE"
+            self.figure_scans.setTitle(title=f"Cell {self.absorbance.cell_name(cell)} at {wavelength_keys[0]} (nm)")
         else:
-            flag_title = "MULTIPLE"
+            self.figure_scans.setTitle(title=f"Cell {self.absorbance.cell_name(cell)}, multiple wavelengths")
         pen = pyqtgraph.mkPen(color='magenta', width=1)
+        abs_ids = np.concatenate([self.absorbance.scan_ids(cell, wavelength) for wavelength in wavelength_keys])
+        self.absorbance.load(abs_ids[self.absorbance.state[abs_ids]])
+        self.show_curves(abs_ids[self.absorbance.state[abs_ids]], pen)
 
-        wavelength_scan = self.cell_wavelength_scan.get(cell)
-        for wavelength in wavelength_keys:
-            for scan, abs_id in wavelength_scan.get(wavelength).items():
-                abs_data = self.absorbance[abs_id]
-                if not abs_data.get("state"):
+    @Slot(bool)
+    def update_heatmap(self, checked):
+        if not checked:
+            for item in [self.heatmap_image, *self.heatmap_lines]:
+                self.figure_scans.removeItem(item)
+            self.figure_scans.getAxis("left").setTicks(None)
+            self.figure_scans.getAxis("left").setLabel(text="Absorbance")
+        if len(self.absorbance) > 0:
+            self.plot_scans()
+
+    def plot_heatmap(self):
+        # Every scan of the cell as one row of a single image, wavelength after wavelength, on the radial grid
+        # of cell_block; the rows of the current cell are kept (only those, they can be as large as the memory
+        # limit of a lazy run) and built again when its scans change, never while a job works on the store.
+        # Unchecked scans are blank rows and the dashed lines mark the region.
+        cell = self.current_cell
+        self.show_curves([], None)
+        if len(self.absorbance.cell_groups(cell)) == 0 or (self.busy and cell not in self.heatmaps):
+            self.figure_scans.removeItem(self.heatmap_image)
+            return
+        with profiler.stage("plot_heatmap") as record:
+            heatmap = self.heatmaps.get(cell)
+            if heatmap is None:
+                wavelengths, grid, scan_ids, cube = cell_block(self.absorbance, cell)
+                filled = scan_ids >= 0
+                heatmap = (wavelengths, grid, scan_ids[filled], cube[filled], np.count_nonzero(filled, axis=1))
+                self.heatmaps.clear()
+                self.heatmaps[cell] = heatmap
+            wavelengths, grid, abs_ids, rows, counts = heatmap
+            if len(grid) == 0:
+                for item in [self.heatmap_image, *self.heatmap_lines]:
+                    self.figure_scans.removeItem(item)
+                self.figure_scans.setTitle(title=f"Cell {self.absorbance.cell_name(cell)}: no scan could be read")
+                return
+            image = np.where(self.absorbance.state[abs_ids][:, None], rows, np.nan)
+            record["items"] = len(image)
+            finite = image[np.isfinite(image)]
+            levels = np.percentile(finite, [1, 99]) if len(finite) > 0 else [0, 1]
+            self.heatmap_image.setImage(image.T, levels=levels, autoLevels=False)
+            self.heatmap_image.setRect(QRectF(grid[0], 0, max(grid[-1] - grid[0], 1e-6), len(image)))
+            if self.heatmap_image not in self.figure_scans.items:
+                self.figure_scans.addItem(self.heatmap_image)
+            # one label per wavelength at its first row, at most about 20 of them
+            starts = np.cumsum(counts) - counts
+            step = max(1, len(wavelengths) // 20)
+            ticks = [(start + 0.5, str(wavelength)) for start, wavelength in
+                     zip(starts[::step].tolist(), wavelengths[::step].tolist())]
+            self.figure_scans.getAxis("left").setTicks([ticks, []])
+            self.figure_scans.getAxis("left").setLabel(text="Wavelength (nm)")
+            self.figure_scans.setTitle(title=f"Cell {self.absorbance.cell_name(cell)}, {len(image)} scans")
+            for line, value in zip(self.heatmap_lines, self.cell_minmax.get(cell, [None, None])):
+                if value is None:
+                    self.figure_scans.removeItem(line)
                     continue
-                min_id = abs_data.get("min_id")
-                max_id = abs_data.get("max_id")
-                x_vals = abs_data.get("x_values")[min_id: max_id]
-                y_vals = abs_data.get("y_values")[min_id: max_id]
-                cell = abs_data.get("cell")
-                if flag_title == "SINGLE":
-                    wavelength = abs_data.get("wavelength")
-                    self.figure_scans.setTitle(title=f"Cell {cell} at {wavelength} (nm)")
-                    flag_title = ""
-                elif flag_title == "MULTIPLE":
-                    self.figure_scans.setTitle(title=f"Cell {cell}, multiple wavelengths")
-                    flag_title = ""
-                curve = self.figure_scans.plot(pen=pen)
+                line.setValue(value)
+                if line not in self.figure_scans.items:
+                    self.figure_scans.addItem(line)
+
+    def show_curves(self, abs_ids, pen):
+        # the curve items are pooled in curve_list and updated in place, the spare ones are hidden
+        with profiler.stage("plot_scans", len(abs_ids)):
+            while len(self.curve_list) < len(abs_ids):
+                curve = pyqtgraph.PlotDataItem()
+                curve.setDownsampling(auto=True, method="peak")
+                curve.setClipToView(True)
+                self.figure_scans.addItem(curve)
+                self.curve_list.append(curve)
+            for curve, abs_id in zip(self.curve_list, abs_ids):
+                x_vals, y_vals = self.absorbance.trimmed(abs_id)
+                curve.setPen(pen)
                 curve.setData(x_vals, y_vals)
+                curve.setVisible(True)
+            for curve in self.curve_list[len(abs_ids):]:
+                if curve.isVisible():
+                    curve.setVisible(False)
+                    curve.setData([], [])
 
-    def set_tw_cell(self):
+    def set_tw_cell(self, keep_current: bool = False, cell_list: list = None):
+        # cell_list lists the cells of a run being loaded, they cannot be selected yet
         self.tw_cell.currentItemChanged.disconnect(self.update_tw_lambda)
         self.tw_cell.clear()
-        cell_list = dict_keys_list(self.cell_wavelength_scan)
+        if cell_list is not None:
+            self.tw_cell.setRowCount(len(cell_list))
+            for i in range(len(cell_list)):
+                self.tw_cell.setItem(i, 0, QTableWidgetItem(str(cell_list[i])))
+            self.tw_cell.setHorizontalHeaderLabels(["Cell"])
+            self.tw_cell.currentItemChanged.connect(self.update_tw_lambda)
+            return
+        cell_list = self.absorbance.cell_keys()
         self.tw_cell.setRowCount(len(cell_list))
         for i in range(len(cell_list)):
-            item = QTableWidgetItem(str(cell_list[i]))
+            item = QTableWidgetItem(self.absorbance.cell_name(cell_list[i]))
+            item.setData(Qt.ItemDataRole.UserRole, cell_list[i])
             item.setFlags(item.flags() & ~Qt.ItemFlag.ItemIsEditable)
             self.tw_cell.setItem(i, 0, item)
         self.tw_cell.setHorizontalHeaderLabels(["Cell"])
         self.tw_cell.verticalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        if keep_current and self.current_cell in cell_list:
+            self.tw_cell.setCurrentCell(cell_list.index(self.current_cell), 0)
         self.tw_cell.currentItemChanged.connect(self.update_tw_lambda)
-        if len(cell_list) > 0:
+        if not keep_current and len(cell_list) > 0:
             self.tw_cell.setCurrentCell(0, 0)
             self.tw_cell.setCurrentItem(self.tw_cell.item(0, 0))
 
@@ -558,34 +1002,22 @@ class MainWindow(QWidget):
             self.plot_last_scans()
             [min_x, max_x] = self.cell_minmax.get(cell)
             if min_x is None or max_x is None:
-                min_x = 5.8
-                max_x = 7.2
+                min_x = RADIAL_MIN
+                max_x = RADIAL_MAX
             self.region_picker.setRegion([min_x, max_x])
             self.figure_scans.addItem(self.region_picker)
         elif state == 0:  # accept and close picker
             [min_val, max_val] = self.region_picker.getRegion()
+            self.figure_scans.removeItem(self.region_picker)
             self.cell_minmax[cell] = [min_val, max_val]
             self.apply_region()
             self.plot_scans()
+            if self.pb_live.isChecked():
+                self.plot_integral()
 
     def apply_region(self):
         cell = self.current_cell
-        [min_x, max_x] = self.cell_minmax.get(cell)
-        wavelength_scan = self.cell_wavelength_scan.get(cell)
-        for wavelength, scan in wavelength_scan.items():
-            for abs_id in scan.values():
-                abs_data = self.absorbance[abs_id]
-                x_val = abs_data.get("x_values")
-                trim_b = np.logical_and(x_val >= min_x, x_val <= max_x)
-                trim_ids = np.where(trim_b)[0]
-                if len(trim_ids) < 10:
-                    min_id = 0
-                    max_id = len(x_val)
-                else:
-                    min_id = trim_ids[0]
-                    max_id = trim_ids[-1]
-                self.absorbance[abs_id]["min_id"] = min_id
-                self.absorbance[abs_id]["max_id"] = max_id
+        apply_regions(self.absorbance, {cell: self.cell_minmax.get(cell)})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,283 @@
+"""Headless batch processing of Beckman absorbance runs.
+
+    python absorbance_batch.py RUN_DIR [RUN_DIR ...] -r regions.json -o OUTPUT_DIR
+
+Each run is loaded, trimmed to the per-cell radial regions, integrated and written to
+OUTPUT_DIR/<run_id>.csv in the same layout as the "Report" button. Regions are read from a JSON
+object {"1": [5.95, 7.05], "*": [6.0, 7.0]} or a CSV file with cell,min_x,max_x rows; the "*"
+entry is used for cells that are not listed. --region MIN MAX sets the region of every cell and
+--auto-region finds the region of each cell between its meniscus and its bottom (see the scan table).
+--reject-outliers unchecks the scans whose integral (or also profile, with "profile") is an outlier among
+the scans of their wavelength before integrating; the scan table shows their state.
+A RUN_DIR may also be a zip or tar archive (.tar.gz etc.) of the run files, which are read without extracting.
+With --memory-limit the scans are parsed a few wavelengths at a time within that many MB.
+--format writes the reports as NPZ (or Parquet/HDF5 when pyarrow/h5py are installed) instead, and
+--scan-table FILE streams the per-scan integrals of every run into one table as the runs finish.
+--timings prints the time and item count of each stage of every run (--trace-memory adds the traced peak
+memory, at the cost of slower stages), --profile-log appends those records to a JSON lines file and
+--profile-stage runs one stage under cProfile.
+--workspace FILE opens every run (directories may hold several) in one workspace, integrates them together
+and writes a single report whose columns are prefixed with the run ID, instead of one report per run.
+--interval bootstrap|jackknife adds the confidence interval of each integral (CI_low/CI_high columns), with
+--resamples bootstrap resamples and --level coverage.
+--spectra FILE fits the integral spectra of every cell of every run, together, as combinations of the reference
+spectra in FILE (a CSV file: wavelength column, then one column per component; --non-negative keeps the
+coefficients >= 0) and writes the coefficients and residual RMS to OUTPUT_DIR/fits.<format>, or next to the
+--workspace report.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from absorbance_core import (REPORT_FORMATS, TableWriter, Workspace, apply_regions, detect_regions, find_outliers,
+                             fit_spectra, fit_table, is_archive, load_run, open_run, profiler, read_spectra,
+                             scan_table, update_cell_integrals, write_report)
+
+
+def read_regions(file_path: str):
+    regions = dict()
+    if file_path.lower().endswith(".json"):
+        with open(file_path) as fid:
+            items = json.load(fid).items()
+    else:
+        with open(file_path, newline="") as fid:
+            items = [(row[0], row[1:3]) for row in csv.reader(fid) if len(row) >= 3]
+    for cell, region in items:
+        cell = cell.strip()
+        try:
+            region = [float(region[0]), float(region[1])]
+        except (ValueError, IndexError, TypeError):
+            continue  # header row or malformed entry
+        if cell == "*":
+            regions[cell] = region
+        elif cell.isdigit():
+            regions[int(cell)] = region
+    return regions
+
+
+def cell_regions(store, regions: dict):
+    # region of every cell key of the store, the regions are given by cell number or detected when None
+    if regions is None:
+        return detect_regions(store)
+    cell_minmax = dict()
+    for cell in store.cell_keys():
+        region = regions.get(cell[1] if isinstance(cell, tuple) else cell, regions.get("*"))
+        if region is not None:
+            cell_minmax[cell] = region
+    return cell_minmax
+
+
+def reject_outliers(store, outliers: str):
+    # unchecks the outliers ("area" or "profile" screening, None for none), returns their count
+    if outliers is None:
+        return 0
+    abs_ids = find_outliers(store, profiles=outliers == "profile")[0]
+    store.set_state(abs_ids, False)
+    return len(abs_ids)
+
+
+def process_workspace(directories: list, regions: dict, file_name: str, n_workers: int = None,
+                      use_cache: bool = True, interval: dict = None, outliers: str = None):
+    workspace = Workspace()
+    for directory in directories:
+        workspace.add_directory(directory, n_workers, use_cache)
+    cell_minmax = cell_regions(workspace, regions)
+    apply_regions(workspace, cell_minmax)
+    reject_outliers(workspace, outliers)
+    cell_integral = dict()
+    update_cell_integrals(workspace, cell_minmax, cell_integral, interval)
+    if all(val is None for val in cell_integral.values()):
+        raise ValueError("Integral profiles not found")
+    write_report(file_name, cell_integral, workspace.report_labels())
+    return workspace, cell_minmax, cell_integral
+
+
+def process_run(directory: str, regions: dict, output_dir: str, n_workers: int = None, use_cache: bool = True,
+                memory_limit: int = None, report_format: str = ".csv", with_scans: bool = False,
+                profile: dict = None, interval: dict = None, outliers: str = None):
+    # profile holds the StageProfiler settings, they are passed along since worker processes start afresh
+    if profile is not None:
+        profiler.configure(**profile)
+        profiler.clear()
+    if memory_limit is None or is_archive(directory):
+        run_id, store = load_run(directory, n_workers, use_cache=use_cache)
+    else:
+        run_id, store = open_run(directory, memory_limit, n_workers)
+    if len(store) == 0:
+        raise ValueError(f"No 'RA' files found in {directory}")
+    cell_minmax = cell_regions(store, regions)
+    apply_regions(store, cell_minmax)
+    n_outliers = reject_outliers(store, outliers)
+    cell_integral = dict()
+    update_cell_integrals(store, cell_minmax, cell_integral, interval)
+    if all(val is None for val in cell_integral.values()):
+        raise ValueError(f"Integral profiles not found for {directory}")
+    file_name = os.path.join(output_dir, f"{run_id}{report_format}")
+    write_report(file_name, cell_integral)
+    table = None
+    if with_scans:
+        table = scan_table(store, cell_minmax)
+    return run_id, len(store), file_name, table, profiler.snapshot(), cell_integral, n_outliers
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Integrate Beckman absorbance runs without the GUI.")
+    parser.add_argument("runs", nargs="+", help="run directories or archives")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-r", "--regions", help="JSON or CSV file with the radial region of each cell")
+    group.add_argument("--region", nargs=2, type=float, metavar=("MIN", "MAX"),
+                       help="radial region (cm) applied to every cell")
+    group.add_argument("--auto-region", action="store_true",
+                       help="detect the region of each cell from its meniscus and bottom")
+    parser.add_argument("-o", "--output-dir", default=".", help="directory of the CSV reports")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--no-cache", action="store_true", help="neither read nor write the run caches")
+    parser.add_argument("--memory-limit", type=float, default=None, metavar="MB",
+                        help="parse the scans on demand, keeping at most MB of them in memory per run")
+    parser.add_argument("-f", "--format", default="csv", choices=[ext[1:] for ext in REPORT_FORMATS],
+                        help="file format of the reports")
+    parser.add_argument("--scan-table", default=None, metavar="FILE",
+                        help="write the state, region and integral of every scan of every run to FILE")
+    parser.add_argument("--workspace", default=None, metavar="FILE",
+                        help="integrate all the runs together and write one combined report to FILE")
+    parser.add_argument("--reject-outliers", nargs="?", const="area", default=None, choices=["area", "profile"],
+                        help="uncheck the outlier scans of each wavelength, by integral or also by profile")
+    parser.add_argument("--interval", default=None, choices=["bootstrap", "jackknife"],
+                        help="add the confidence interval of each integral to the reports")
+    parser.add_argument("--resamples", type=int, default=2000, help="bootstrap resamples of --interval")
+    parser.add_argument("--level", type=float, default=0.95, help="coverage of the --interval intervals")
+    parser.add_argument("--spectra", default=None, metavar="FILE",
+                        help="fit the integral spectra with the reference spectra of FILE")
+    parser.add_argument("--non-negative", action="store_true", help="keep the --spectra coefficients >= 0")
+    parser.add_argument("--timings", action="store_true", help="print the time of each stage")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also record the peak memory of each stage, the stages run slower")
+    parser.add_argument("--profile-log", default=None, metavar="FILE",
+                        help="append the record of each stage to FILE as JSON lines")
+    parser.add_argument("--profile-stage", default=None, metavar="STAGE",
+                        help="run STAGE (e.g. parse_file) under cProfile, the statistics go to STAGE.prof")
+    args = parser.parse_args(argv)
+
+    regions = None
+    if args.regions is not None:
+        regions = read_regions(args.regions)
+    elif args.region is not None:
+        regions = {"*": args.region}
+    os.makedirs(args.output_dir, exist_ok=True)
+    use_cache = not args.no_cache
+    memory_limit = None
+    if args.memory_limit is not None:
+        memory_limit = int(args.memory_limit * 2 ** 20)
+    n_jobs = args.jobs or os.cpu_count() or 1
+    report_format = "." + args.format
+    with_scans = args.scan_table is not None
+    writer = None
+    if with_scans:
+        try:
+            writer = TableWriter(args.scan_table)
+        except ValueError as error:
+            parser.error(str(error))
+
+    profile = None
+    if args.timings or args.trace_memory or args.profile_log is not None or args.profile_stage is not None:
+        profile = {"trace_memory": args.trace_memory, "log_file": args.profile_log, "profile_stage": args.profile_stage}
+
+    references = None
+    if args.spectra is not None:
+        try:
+            references = read_spectra(args.spectra)
+        except (OSError, ValueError) as error:
+            parser.error(str(error))
+
+    def write_fits(file_name, cell_integral, labels):
+        # all the cells of all the runs are fitted at once
+        wavelengths, names, spectra = references
+        cell_fit = fit_spectra(cell_integral, wavelengths, spectra, args.non_negative)
+        with TableWriter(file_name) as fit_writer:
+            fit_writer.write(fit_table(cell_fit, names, labels))
+        print(f"{len(cell_fit)} cells fitted -> {file_name}")
+
+    interval = None
+    if args.interval is not None:
+        interval = {"method": args.interval, "n_resamples": args.resamples, "level": args.level}
+
+    if args.workspace is not None:
+        try:
+            workspace, cell_minmax, cell_integral = process_workspace(args.runs, regions, args.workspace, n_jobs,
+                                                                      use_cache, interval, args.reject_outliers)
+        except (OSError, ValueError) as error:
+            print(error, file=sys.stderr)
+            return 1
+        if writer is not None:
+            writer.write(scan_table(workspace, cell_minmax))
+            writer.close()
+        line = f"{len(workspace.run_ids)} runs, {len(workspace)} scans"
+        if args.reject_outliers is not None:
+            line += f", {int(np.sum(~workspace.state))} outliers rejected"
+        print(f"{line} -> {args.workspace}")
+        if references is not None:
+            write_fits(os.path.splitext(args.workspace)[0] + "_fits" + os.path.splitext(args.workspace)[1],
+                       cell_integral, workspace.report_labels())
+        return 0
+
+    failed = 0
+    run_integrals = dict()
+    run_labels = dict()
+
+    def report(directory, result):
+        # each run is written out as soon as it is done, only the summary line is kept
+        nonlocal failed
+        if isinstance(result, Exception):
+            failed += 1
+            print(f"{directory}: {result}", file=sys.stderr)
+            return
+        run_id, n_scans, file_name, table, records, cell_integral, n_outliers = result
+        if references is not None:
+            for cell, val in cell_integral.items():
+                run_integrals[directory, cell] = val
+                run_labels[directory, cell] = f"{run_id}_Cell_{cell}"
+        if writer is not None:
+            writer.write({"run": np.full(len(table["cell"]), run_id), **table})
+        line = f"{directory}: run {run_id}, {n_scans} scans"
+        if args.reject_outliers is not None:
+            line += f", {n_outliers} outliers rejected"
+        print(f"{line} -> {file_name}")
+        if args.timings:
+            for record in records:
+                line = f"  {record['stage']:<14}{record['seconds'] * 1e3:10.2f} ms{record['items']:8d} items"
+                if record["peak_bytes"] is not None:
+                    line += f"{record['peak_bytes'] / 2 ** 20:10.2f} MB"
+                print(line)
+
+    if len(args.runs) == 1 or n_jobs == 1:
+        # one run at a time, its files are parsed in parallel instead
+        for directory in args.runs:
+            try:
+                result = process_run(directory, regions, args.output_dir, n_jobs, use_cache, memory_limit,
+                                     report_format, with_scans, profile, interval, args.reject_outliers)
+            except (OSError, ValueError) as error:
+                result = error
+            report(directory, result)
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(args.runs))) as pool:
+            futures = [pool.submit(process_run, directory, regions, args.output_dir, 1, use_cache, memory_limit,
+                                   report_format, with_scans, profile, interval, args.reject_outliers)
+                       for directory in args.runs]
+            for directory, future in zip(args.runs, futures):
+                try:
+                    result = future.result()
+                except (OSError, ValueError) as error:
+                    result = error
+                report(directory, result)
+    if writer is not None:
+        writer.close()
+    if references is not None:
+        write_fits(os.path.join(args.output_dir, "fits" + report_format), run_integrals, run_labels)
+    return 1 if failed > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1816 @@
+import numpy as np
+import os
+import cProfile
+import contextlib
+import glob
+import json
+import multiprocessing
+import time
+import tarfile
+import tempfile
+import threading
+import tracemalloc
+import warnings
+import zipfile
+from functools import partial
+from collections import OrderedDict
+from statistics import NormalDist
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+RADIAL_MIN = 5.8  # radial window (cm) kept by parse_file
+RADIAL_MAX = 7.2
+CACHE_DIR = ".absorbance_cache"  # sidecar cache of the parsed scans, kept inside the run directory
+CACHE_VERSION = 1
+CACHE_ARRAYS = ("x_data", "y_data", "offsets", "sizes", "cell", "scan", "wavelength")
+MEMORY_LIMIT = 512 * 2 ** 20  # bytes of scan arrays a LazyScanStore keeps in memory
+BOOTSTRAP_CHUNK = 2 ** 22  # resampled areas drawn at once by group_intervals
+TAR_BATCH = 64  # tar members parsed per worker task
+ALIGN_CHUNK = 4096  # scans resampled together by resample
+COMPACT_CHUNK = 2 ** 16  # points moved or summed at once by LazyScanStore.compact and add_areas
+FIT_ITERATIONS = 5000  # projected gradient steps of a non-negative fit_spectra
+FIT_TOLERANCE = 1e-9  # relative coefficient change that ends them
+OUTLIER_THRESHOLD = 5.0  # robust score beyond which find_outliers rejects a scan
+OUTLIER_MIN_SCANS = 4  # checked scans a group needs to be screened
+OUTLIER_MIN_PROFILES = 10  # checked scans a group needs for its profiles to be screened
+OUTLIER_PROFILE_FLOOR = 0.1  # fraction of the median RMS deviation of a group below which its spread never falls
+EDGE_THRESHOLD = 8.0  # robust spreads of dA/dr above which detect_regions sees the meniscus or the bottom
+EDGE_MARGIN = 0.03  # cm kept clear of the meniscus and the bottom by detect_regions
+REPORT_FORMATS = {".csv": "CSV", ".npz": "NumPy"}  # report file extensions, Parquet and HDF5 need pyarrow/h5py
+if pyarrow is not None:
+    REPORT_FORMATS[".parquet"] = "Parquet"
+if h5py is not None:
+    REPORT_FORMATS[".h5"] = "HDF5"
+open_archives = dict()  # zip archives opened by read_zip_member in this process
+# start method of the parser processes: forking a process with running threads (the GUI) can deadlock them
+POOL_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+
+class StageProfiler:
+    # Records the wall time, item count and (with trace_memory) traced peak memory of each stage of the
+    # pipeline; tracing slows the stages down a few times, so it is off unless asked for. Disabled, stage()
+    # hands out a shared null context. The peaks of the enclosing stages are kept per thread. Every record is
+    # passed to the listeners, in the thread that recorded it, appended as a JSON line to log_file when set,
+    # and the stage named profile_stage runs under cProfile with its statistics dumped to profile_file
+    # (default <stage>.prof). "records" is only changed under "lock", snapshot() copies it.
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.log_file = None
+        self.profile_stage = None
+        self.profile_file = None
+        self.records = OrderedDict()
+        self.listeners = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.null_stage = contextlib.nullcontext(dict())
+
+    def configure(self, enabled: bool = True, trace_memory: bool = False, log_file: str = None,
+                  profile_stage: str = None, profile_file: str = None):
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.log_file = log_file
+        self.profile_stage = profile_stage
+        self.profile_file = profile_file
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif not self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def stage(self, name: str, items: int = 0):
+        # the yielded record takes the item count once it is known, record["items"] = n
+        if not self.enabled:
+            return self.null_stage
+        return self.run_stage(name, items)
+
+    @contextlib.contextmanager
+    def run_stage(self, name: str, items: int):
+        record = {"stage": name, "items": items, "start": time.time(), "seconds": 0.0, "peak_bytes": None}
+        profile = None
+        if name == self.profile_stage:
+            profile = cProfile.Profile()
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            if not hasattr(self.local, "peaks"):
+                self.local.peaks = []
+            peaks = self.local.peaks
+            # an enclosing stage keeps the peak reached before this one started
+            if len(peaks) > 0:
+                peaks[-1] = max(peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            peaks.append(0)
+        start = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+            record["seconds"] = time.perf_counter() - start
+            if tracing:
+                peak = max(peaks.pop(), tracemalloc.get_traced_memory()[1])
+                record["peak_bytes"] = max(peak - base, 0)
+                if len(peaks) > 0:
+                    peaks[-1] = max(peaks[-1], peak)
+                tracemalloc.reset_peak()
+            if profile is not None:
+                profile.dump_stats(self.profile_file or f"{name}.prof")
+            self.add_record(record)
+
+    def snapshot(self):
+        # latest record of each stage, the most recent last
+        with self.lock:
+            return [dict(record) for record in self.records.values()]
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+    def add_record(self, record: dict):
+        with self.lock:
+            self.records[record["stage"]] = record
+            self.records.move_to_end(record["stage"])
+        if self.log_file is not None:
+            with open(self.log_file, "a") as fid:
+                fid.write(json.dumps({"pid": os.getpid(), **record}) + "\n")
+        for listener in self.listeners:
+            listener(record)
+
+
+profiler = StageProfiler()
+
+
+class Cancelled(Exception):
+    # raised by the long-running functions once their cancel event is set
+    pass
+
+
+def check_cancel(cancel):
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+
+
+def str2float(x):
+    try:
+        return float(x)
+    except ValueError:
+        return None
+
+
+def parse_file(file_path, min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX):
+    with open(file_path) as fid:
+        return parse_text(fid.read(), min_x, max_x)
+
+
+def parse_text(text: str, min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX):
+    lines = text.splitlines()
+    if len(lines) < 3:
+        return []
+    body = lines[2:]
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            xy_values = np.loadtxt(body, dtype=np.float64, comments=None, ndmin=2)
+        if xy_values.shape[1] != 3:
+            raise ValueError
+    except ValueError:
+        # malformed lines, keep the rows with three fields whose first two are numbers
+        rows = [lsp for lsp in (line.split() for line in body) if len(lsp) == 3]
+        xy_list = [(str2float(lsp[0]), str2float(lsp[1])) for lsp in rows]
+        xy_list = [xy for xy in xy_list if xy[0] is not None and xy[1] is not None]
+        xy_values = np.array(xy_list, dtype=np.float64).reshape(-1, 2)
+    x_values = xy_values[:, 0]
+    mask = np.logical_and(x_values >= min_x, x_values <= max_x)
+    if np.any(mask):
+        return x_values[mask].astype(np.float32), xy_values[mask, 1].astype(np.float32)
+    else:
+        return []
+
+
+def get_file_info(f_name: str):
+    dot_sp = f_name.split(".")
+    if len(dot_sp) != 2 or len(dot_sp[1]) != 3:
+        return []
+    if dot_sp[1][0: 2] != "ra" and dot_sp[1][0: 2] != "ri":
+        return []
+    dash_sp = dot_sp[0].split("-")
+    if len(dash_sp) != 7:
+        return []
+    run_id = dash_sp[0]
+    cell = int(dash_sp[2][1:])
+    scan = int(dash_sp[3][1:])
+    wavelength = int(dash_sp[4][1: 4])
+    return run_id, cell, scan, wavelength
+
+
+def read_scan_file(file_path: str, min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX):
+    file_info = get_file_info(os.path.split(file_path)[1])
+    if len(file_info) == 0:
+        return []
+    file_parsed = parse_file(file_path, min_x, max_x)
+    if len(file_parsed) == 0:
+        return []
+    run_id, cell, scan, wavelength = file_info
+    return run_id, cell, scan, wavelength, file_parsed[0], file_parsed[1]
+
+
+def read_scan_text(f_name: str, data: bytes, min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX):
+    # read_scan_file of the content of a file named f_name, e.g. an archive member
+    file_info = get_file_info(f_name)
+    if len(file_info) == 0:
+        return []
+    file_parsed = parse_text(data.decode(errors="replace"), min_x, max_x)
+    if len(file_parsed) == 0:
+        return []
+    run_id, cell, scan, wavelength = file_info
+    return run_id, cell, scan, wavelength, file_parsed[0], file_parsed[1]
+
+
+def read_scan_texts(members: list, min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX):
+    return [read_scan_text(f_name, data, min_x, max_x) for f_name, data in members]
+
+
+def read_zip_member(name: str, archive: str, min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX):
+    # the archive stays open in each process for its next members, read_archive closes it
+    handle = open_archives.get(archive)
+    if handle is None:
+        handle = open_archives[archive] = zipfile.ZipFile(archive)
+    return read_scan_text(name.rsplit("/", 1)[-1], handle.read(name), min_x, max_x)
+
+
+def read_scan_files(file_list: list, n_workers: int = None, use_threads: bool = False,
+                    min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX, progress=None, cancel=None,
+                    archive: str = None):
+    # results come back in the order of file_list whatever the worker count; progress(done, total) is called
+    # for every parsed file and setting the cancel event (threading.Event) stops the parsing with Cancelled.
+    # With a zip archive, file_list holds member names and the workers decompress them in parallel
+    if archive is None:
+        read_file = partial(read_scan_file, min_x=min_x, max_x=max_x)
+    else:
+        read_file = partial(read_zip_member, archive=archive, min_x=min_x, max_x=max_x)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    file_scans = []
+    with profiler.stage("parse_file", len(file_list)):
+        if n_workers <= 1 or len(file_list) < 2:
+            for fpath in file_list:
+                check_cancel(cancel)
+                file_scans.append(read_file(fpath))
+                if progress is not None:
+                    progress(len(file_scans), len(file_list))
+            return file_scans
+        n_workers = min(n_workers, len(file_list))
+        chunk_size = max(1, len(file_list) // (n_workers * 4))
+        if use_threads:
+            executor = ThreadPoolExecutor(max_workers=n_workers)
+        else:
+            executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=POOL_CONTEXT)
+        with executor as pool:
+            for file_scan in pool.map(read_file, file_list, chunksize=chunk_size):
+                if cancel is not None and cancel.is_set():
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    raise Cancelled()
+                file_scans.append(file_scan)
+                if progress is not None:
+                    progress(len(file_scans), len(file_list))
+        return file_scans
+
+
+def compare_x_array(arr1: np.array, arr2: np.array):
+    len_chk = len(arr1) == len(arr2)
+    i_chk = round(arr1[0], 3) == round(arr2[0], 3)
+    f_chk = round(arr1[-1], 3) == round(arr2[-1], 3)
+    if len_chk and i_chk and f_chk:
+        return True
+    else:
+        return False
+
+
+def group_keys(cells, wavelengths, runs=None):
+    # one sortable int64 key per (run, cell, wavelength)
+    keys = (np.asarray(cells, dtype=np.int64) << 32) | np.asarray(wavelengths, dtype=np.int64)
+    if runs is not None:
+        keys |= np.asarray(runs, dtype=np.int64) << 48
+    return keys
+
+
+class ScanStore:
+    # Scans of a run in contiguous radius/absorbance buffers. A scan is addressed by its abs_id (insertion
+    # order); per-scan columns are indexed by abs_id, and "order" lists the abs_ids sorted by
+    # (cell, wavelength, scan) so each (cell, wavelength) group is a contiguous slice of it.
+    # area_data holds the running trapezoid sum along the buffers, so the integral of a scan between two
+    # of its points is a difference of two entries; nan_segments lists the non-finite trapezoids.
+    # group_mean/std/count cache the integral statistics of each group and group_low/high its confidence
+    # interval, computed with the "interval" settings (None for none); "dirty" flags the groups whose
+    # scan states or trim indices changed since they were last integrated.
+    # The point buffers are views into x/y/area_buffer, which grow geometrically as scans are appended.
+    # min_x/max_x is the radial window the scan files are parsed with. "run" numbers the run of each scan
+    # (always 0 outside a Workspace) and groups are (run, cell, wavelength); the per-cell methods take a cell
+    # key, the cell number here, whose int64 form is its "code". "files" lists the scan files read into the
+    # store, those that could not be parsed too, so a RunWatcher knows which files are new.
+    def __init__(self, min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX):
+        self.min_x = min_x
+        self.max_x = max_x
+        self.files = []
+        self.x_buffer = np.empty(0, dtype=np.float32)
+        self.y_buffer = np.empty(0, dtype=np.float32)
+        self.area_buffer = np.empty(0, dtype=np.float64)
+        self.x_data = self.x_buffer
+        self.y_data = self.y_buffer
+        self.area_data = self.area_buffer
+        self.nan_segments = np.empty(0, dtype=np.int64)
+        self.offsets = np.empty(0, dtype=np.int64)
+        self.sizes = np.empty(0, dtype=np.int64)
+        self.run = np.empty(0, dtype=np.int32)
+        self.cell = np.empty(0, dtype=np.int32)
+        self.wavelength = np.empty(0, dtype=np.int32)
+        self.scan = np.empty(0, dtype=np.int32)
+        self.state = np.empty(0, dtype=bool)
+        self.min_id = np.empty(0, dtype=np.int64)
+        self.max_id = np.empty(0, dtype=np.int64)
+        self.order = np.empty(0, dtype=np.int64)
+        self.group_id = np.empty(0, dtype=np.int64)
+        self.group_run = np.empty(0, dtype=np.int32)
+        self.group_cell = np.empty(0, dtype=np.int32)
+        self.group_wavelength = np.empty(0, dtype=np.int32)
+        self.group_offsets = np.zeros(1, dtype=np.int64)
+        self.group_mean = np.empty(0, dtype=np.float64)
+        self.group_std = np.empty(0, dtype=np.float64)
+        self.group_count = np.empty(0, dtype=np.int64)
+        self.group_low = np.empty(0, dtype=np.float64)
+        self.group_high = np.empty(0, dtype=np.float64)
+        self.interval = None
+        self.dirty = np.empty(0, dtype=bool)
+
+    def __len__(self):
+        return len(self.cell)
+
+    def clear(self):
+        self.__init__(self.min_x, self.max_x)
+
+    def add_files(self, file_list: list, n_workers: int = None):
+        file_scans = read_scan_files(file_list, n_workers, min_x=self.min_x, max_x=self.max_x)
+        self.files.extend(file_list)
+        file_scans = [file_scan for file_scan in file_scans if len(file_scan) > 0]
+        if len(file_scans) == 0:
+            return np.empty(0, dtype=np.int64)
+        _, cells, scans, wavelengths, x_list, y_list = zip(*file_scans)
+        return self.append(cells, scans, wavelengths, x_list, y_list)
+
+    def load(self, abs_ids):
+        pass  # every scan of an in-memory store is loaded
+
+    def loaded_batches(self, groups):
+        # yields the groups in batches whose scans are loaded
+        yield np.asarray(groups, dtype=np.int64)
+
+    def defer_trim(self, abs_ids, min_x, max_x):
+        # flags the scans whose trim indices can be found now, the region of the others is kept for later
+        return np.ones(len(abs_ids), dtype=bool)
+
+    def append(self, cells, scans, wavelengths, x_list: list, y_list: list, runs=None):
+        n_new = len(x_list)
+        if n_new == 0:
+            return np.empty(0, dtype=np.int64)
+        sizes = np.array([len(x_vals) for x_vals in x_list], dtype=np.int64)
+        offsets = np.zeros(n_new, dtype=np.int64)
+        np.cumsum(sizes[:-1], out=offsets[1:])
+        offsets += len(self.x_data)
+        abs_ids = np.arange(len(self), len(self) + n_new)
+        n_points = len(self.x_data)
+        n_total = n_points + int(np.sum(sizes))
+        self.reserve(n_total)
+        self.x_data = self.x_buffer[:n_total]
+        self.y_data = self.y_buffer[:n_total]
+        self.area_data = self.area_buffer[:n_total]
+        np.concatenate(x_list, out=self.x_data[n_points:], casting="same_kind")
+        np.concatenate(y_list, out=self.y_data[n_points:], casting="same_kind")
+        self.add_areas(n_points)
+        self.offsets = np.concatenate([self.offsets, offsets])
+        self.sizes = np.concatenate([self.sizes, sizes])
+        if runs is None:
+            runs = np.zeros(n_new, dtype=np.int32)
+        self.run = np.concatenate([self.run, np.asarray(runs, dtype=np.int32)])
+        self.cell = np.concatenate([self.cell, np.asarray(cells, dtype=np.int32)])
+        self.wavelength = np.concatenate([self.wavelength, np.asarray(wavelengths, dtype=np.int32)])
+        self.scan = np.concatenate([self.scan, np.asarray(scans, dtype=np.int32)])
+        self.state = np.concatenate([self.state, np.ones(n_new, dtype=bool)])
+        self.min_id = np.concatenate([self.min_id, np.zeros(n_new, dtype=np.int64)])
+        self.max_id = np.concatenate([self.max_id, sizes])
+        self.build_index()
+        self.dirty[self.group_id[abs_ids]] = True
+        return abs_ids
+
+    def reserve(self, n_points: int):
+        if n_points <= len(self.x_buffer):
+            return
+        capacity = max(n_points, 2 * len(self.x_buffer))
+        n_used = len(self.x_data)
+        x_buffer = np.empty(capacity, dtype=np.float32)
+        y_buffer = np.empty(capacity, dtype=np.float32)
+        area_buffer = np.empty(capacity, dtype=np.float64)
+        x_buffer[:n_used] = self.x_data
+        y_buffer[:n_used] = self.y_data
+        area_buffer[:n_used] = self.area_data
+        self.x_buffer, self.y_buffer, self.area_buffer = x_buffer, y_buffer, area_buffer
+
+    def build_index(self):
+        # group statistics are carried over by (run, cell, wavelength) key, new groups start dirty
+        with profiler.stage("build_index", len(self)):
+            old_keys = group_keys(self.group_cell, self.group_wavelength, self.group_run)
+            old_mean, old_std, old_count, old_dirty = self.group_mean, self.group_std, self.group_count, self.dirty
+            old_low, old_high = self.group_low, self.group_high
+            n_scans = len(self)
+            self.order = np.lexsort((self.scan, self.wavelength, self.cell, self.run))
+            run = self.run[self.order]
+            cell = self.cell[self.order]
+            wavelength = self.wavelength[self.order]
+            new_group = np.ones(n_scans, dtype=bool)
+            new_group[1:] = np.logical_or(cell[1:] != cell[:-1], wavelength[1:] != wavelength[:-1])
+            new_group[1:] |= run[1:] != run[:-1]
+            starts = np.flatnonzero(new_group)
+            self.group_run = run[starts]
+            self.group_cell = cell[starts]
+            self.group_wavelength = wavelength[starts]
+            self.group_offsets = np.append(starts, n_scans)
+            self.group_id = np.empty(n_scans, dtype=np.int64)
+            self.group_id[self.order] = np.cumsum(new_group) - 1
+            n_groups = len(starts)
+            self.group_mean = np.zeros(n_groups, dtype=np.float64)
+            self.group_std = np.zeros(n_groups, dtype=np.float64)
+            self.group_count = np.zeros(n_groups, dtype=np.int64)
+            self.group_low = np.full(n_groups, np.nan)
+            self.group_high = np.full(n_groups, np.nan)
+            self.dirty = np.ones(n_groups, dtype=bool)
+            if len(old_keys) > 0:
+                keys = group_keys(self.group_cell, self.group_wavelength, self.group_run)
+                position = np.minimum(np.searchsorted(old_keys, keys), len(old_keys) - 1)
+                found = old_keys[position] == keys
+                position = position[found]
+                self.group_mean[found] = old_mean[position]
+                self.group_std[found] = old_std[position]
+                self.group_count[found] = old_count[position]
+                self.group_low[found] = old_low[position]
+                self.group_high[found] = old_high[position]
+                self.dirty[found] = old_dirty[position]
+
+    def set_state(self, abs_ids, state):
+        self.state[abs_ids] = state
+        self.dirty[self.group_id[abs_ids]] = True
+
+    def set_trim(self, abs_ids, min_ids, max_ids):
+        self.min_id[abs_ids] = min_ids
+        self.max_id[abs_ids] = max_ids
+        self.dirty[self.group_id[abs_ids]] = True
+
+    def add_areas(self, start: int):
+        # running trapezoid sums of the buffers from point "start" on, written into area_data COMPACT_CHUNK
+        # points at a time; each chunk carries the sum on, so the result is that of one cumsum
+        n_points = len(self.x_data)
+        self.area_data[start: start + 1] = 0
+        nan_segments = [self.nan_segments[self.nan_segments < start]]
+        for first in range(start, n_points - 1, COMPACT_CHUNK):
+            last = min(first + COMPACT_CHUNK, n_points - 1)
+            x_vals = self.x_data[first: last + 1].astype(np.float64)
+            y_vals = self.y_data[first: last + 1].astype(np.float64)
+            segments = np.diff(x_vals) * (y_vals[1:] + y_vals[:-1]) * 0.5
+            finite = np.isfinite(segments)
+            segments[~finite] = 0
+            segments[0] += self.area_data[first]
+            np.cumsum(segments, out=self.area_data[first + 1: last + 1])
+            nan_segments.append(np.flatnonzero(~finite) + first)
+        self.nan_segments = np.concatenate(nan_segments)
+
+    def set_arrays(self, x_data, y_data, offsets, sizes, cell, scan, wavelength):
+        # x_data/y_data are used as given, so they can be memory maps of the run cache
+        self.clear()
+        self.x_data = x_data
+        self.y_data = y_data
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.sizes = np.array(sizes, dtype=np.int64)
+        self.run = np.zeros(len(cell), dtype=np.int32)
+        self.cell = np.array(cell, dtype=np.int32)
+        self.scan = np.array(scan, dtype=np.int32)
+        self.wavelength = np.array(wavelength, dtype=np.int32)
+        self.state = np.ones(len(self.cell), dtype=bool)
+        self.min_id = np.zeros(len(self.cell), dtype=np.int64)
+        self.max_id = self.sizes.copy()
+        self.area_buffer = np.empty(len(x_data), dtype=np.float64)
+        self.area_data = self.area_buffer
+        self.add_areas(0)
+        self.build_index()
+
+    def x_values(self, abs_id: int):
+        offset = self.offsets[abs_id]
+        return self.x_data[offset: offset + self.sizes[abs_id]]
+
+    def y_values(self, abs_id: int):
+        offset = self.offsets[abs_id]
+        return self.y_data[offset: offset + self.sizes[abs_id]]
+
+    def trimmed(self, abs_id: int):
+        offset = self.offsets[abs_id]
+        first, last = offset + self.min_id[abs_id], offset + self.max_id[abs_id]
+        return self.x_data[first: last], self.y_data[first: last]
+
+    def areas(self, abs_ids):
+        # trapezoid integral of each scan between its trim indices
+        abs_ids = np.asarray(abs_ids, dtype=np.int64)
+        if len(self.area_data) == 0:
+            return np.zeros(len(abs_ids))  # no scan has points
+        first = self.offsets[abs_ids] + self.min_id[abs_ids]
+        last = np.maximum(self.offsets[abs_ids] + self.max_id[abs_ids] - 1, first)
+        first = np.minimum(first, len(self.area_data) - 1)
+        last = np.minimum(last, len(self.area_data) - 1)
+        areas = self.area_data[last] - self.area_data[first]
+        if len(self.nan_segments) > 0:
+            has_nan = np.searchsorted(self.nan_segments, first) < np.searchsorted(self.nan_segments, last)
+            areas[has_nan] = np.nan
+        return areas
+
+    def cells(self):
+        return np.unique(self.group_cell)
+
+    def cell_code(self, cell):
+        return int(cell)
+
+    def code_key(self, code: int):
+        return int(code)
+
+    def scan_codes(self, abs_ids):
+        return self.cell[abs_ids].astype(np.int64)
+
+    def group_codes(self):
+        return self.group_cell.astype(np.int64)
+
+    def cell_keys(self):
+        return [self.code_key(code) for code in np.unique(self.group_codes()).tolist()]
+
+    def cell_name(self, cell):
+        return str(cell)
+
+    def report_labels(self):
+        return {cell: f"Cell_{cell}" for cell in self.cell_keys()}
+
+    def wavelengths(self, cell):
+        return self.group_wavelength[self.cell_groups(cell)]
+
+    def cell_groups(self, cell):
+        return np.flatnonzero(self.group_codes() == self.cell_code(cell))
+
+    def find_group(self, cell, wavelength: int):
+        groups = self.cell_groups(cell)
+        group = groups[self.group_wavelength[groups] == wavelength]
+        if len(group) == 0:
+            return -1
+        return group[0]
+
+    def group_scans(self, group: int):
+        return self.order[self.group_offsets[group]: self.group_offsets[group + 1]]
+
+    def scan_ids(self, cell, wavelength: int):
+        group = self.find_group(cell, wavelength)
+        if group < 0:
+            return np.empty(0, dtype=np.int64)
+        return self.group_scans(group)
+
+    def cell_scans(self, cell):
+        groups = self.cell_groups(cell)
+        if len(groups) == 0:
+            return np.empty(0, dtype=np.int64)
+        return self.order[self.group_offsets[groups[0]]: self.group_offsets[groups[-1] + 1]]
+
+    def last_scans(self, cell):
+        # scan with the highest number of each wavelength
+        return self.order[self.group_offsets[self.cell_groups(cell) + 1] - 1]
+
+    def is_valid(self, abs_ids):
+        # flags the scans whose file could be parsed, all of them in memory
+        return np.ones(len(abs_ids), dtype=bool)
+
+
+def list_scan_files(directory: str):
+    with profiler.stage("glob") as record:
+        glob_list = sorted(glob.glob(os.path.join(directory, "*.ra*")))
+        record["items"] = len(glob_list)
+    with profiler.stage("get_file_info", len(glob_list)):
+        return [fpath for fpath in glob_list if len(get_file_info(os.path.split(fpath)[1])) > 0]
+
+
+def is_archive(path: str):
+    return os.path.isfile(path) and (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+
+def archive_files(archive: str):
+    # names of the scan file members of a zip or tar archive, sorted
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as handle:
+            names = [info.filename for info in handle.infolist() if not info.is_dir()]
+    else:
+        with tarfile.open(archive, "r:*") as tar:
+            names = [member.name for member in tar if member.isfile()]
+    return sorted(name for name in names if len(get_file_info(name.rsplit("/", 1)[-1])) > 0)
+
+
+def read_tar(archive: str, n_workers: int = None, min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX,
+             progress=None, cancel=None):
+    # A tar archive is decompressed as one stream, in member order, and the members are handed to the worker
+    # processes TAR_BATCH at a time as they come out; progress(done, total) follows the compressed bytes read.
+    # Returns the member names and their read_scan_file results, sorted by name.
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    names, batches, members = [], [], []
+    size = os.path.getsize(archive)
+    pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=POOL_CONTEXT) if n_workers > 1 else None
+    read_members = partial(read_scan_texts, min_x=min_x, max_x=max_x)
+    try:
+        with open(archive, "rb") as raw, tarfile.open(fileobj=raw, mode="r|*") as tar:
+            for member in tar:
+                check_cancel(cancel)
+                f_name = member.name.rsplit("/", 1)[-1]
+                if not member.isfile() or len(get_file_info(f_name)) == 0:
+                    continue
+                names.append(member.name)
+                members.append((f_name, tar.extractfile(member).read()))
+                if len(members) == TAR_BATCH or pool is None:
+                    batches.append(read_members(members) if pool is None else pool.submit(read_members, members))
+                    members = []
+                if progress is not None:
+                    progress(raw.tell(), size)
+        if len(members) > 0:
+            batches.append(pool.submit(read_members, members))
+        file_scans = []
+        for batch in batches:
+            check_cancel(cancel)
+            file_scans += batch if pool is None else batch.result()
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=cancel is None or not cancel.is_set(), cancel_futures=True)
+    order = sorted(range(len(names)), key=names.__getitem__)
+    return [names[i] for i in order], [file_scans[i] for i in order]
+
+
+def read_archive(archive: str, n_workers: int = None, min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX,
+                 progress=None, cancel=None):
+    # Scan file members of a zip or tar archive, parsed in memory without extracting them. Zip members are
+    # decompressed and parsed by the workers in parallel, see read_scan_files and read_tar. Returns the member
+    # names and their read_scan_file results.
+    if not zipfile.is_zipfile(archive):
+        with profiler.stage("parse_file") as record:
+            names, file_scans = read_tar(archive, n_workers, min_x, max_x, progress, cancel)
+            record["items"] = len(names)
+        return names, file_scans
+    names = archive_files(archive)
+    try:
+        file_scans = read_scan_files(names, n_workers, min_x=min_x, max_x=max_x, progress=progress, cancel=cancel,
+                                     archive=archive)
+    finally:
+        handle = open_archives.pop(archive, None)
+        if handle is not None:
+            handle.close()
+    return names, file_scans
+
+
+def load_archive(archive: str, n_workers: int = None, min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX,
+                 progress=None, cancel=None):
+    # load_run of a zip or tar archive of a run, nothing is extracted or cached
+    return store_scans(read_archive(archive, n_workers, min_x, max_x, progress, cancel)[1], min_x, max_x)
+
+
+def store_scans(file_scans: list, min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX):
+    # run ID and ScanStore of the read_scan_file results of one run
+    file_scans = [file_scan for file_scan in file_scans if len(file_scan) > 0]
+    store = ScanStore(min_x, max_x)
+    if len(file_scans) == 0:
+        return None, store
+    run_ids, cells, scans, wavelengths, x_list, y_list = zip(*file_scans)
+    found = sorted(set(run_ids))
+    if len(found) > 1:
+        raise ValueError(f"More than one run ID found:\n{found[0]}\n{found[1]}")
+    store.append(cells, scans, wavelengths, x_list, y_list)
+    return run_ids[0], store
+
+
+def scan_files_size(directory: str):
+    return sum(os.path.getsize(fpath) for fpath in list_scan_files(directory))
+
+
+def read_run_cache(directory: str, min_x: float, max_x: float):
+    cache_dir = os.path.join(directory, CACHE_DIR)
+    try:
+        with open(os.path.join(cache_dir, "manifest.json")) as fid:
+            manifest = json.load(fid)
+        if manifest.get("version") != CACHE_VERSION or manifest.get("window") != [min_x, max_x]:
+            return None
+        arrays = dict()
+        for name in CACHE_ARRAYS:
+            arrays[name] = np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if len(arrays["x_data"]) != manifest.get("n_points") or len(arrays["cell"]) != manifest.get("n_scans"):
+        return None
+    return manifest.get("files"), arrays
+
+
+def write_run_cache(directory: str, files: list, store: ScanStore, min_x: float, max_x: float):
+    cache_dir = os.path.join(directory, CACHE_DIR)
+    manifest_path = os.path.join(cache_dir, "manifest.json")
+    manifest = {"version": CACHE_VERSION, "window": [min_x, max_x], "n_scans": len(store),
+                "n_points": len(store.x_data), "files": files}
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        for name in CACHE_ARRAYS:
+            temp_path = os.path.join(cache_dir, name + ".tmp.npy")
+            np.save(temp_path, getattr(store, name))
+            os.replace(temp_path, os.path.join(cache_dir, name + ".npy"))
+        with open(manifest_path, "w") as fid:
+            json.dump(manifest, fid)
+    except OSError:
+        pass  # read-only run directory, the run still loads without a cache
+
+
+def load_run(directory: str, n_workers: int = None, min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX,
+             use_cache: bool = True, progress=None, cancel=None):
+    # Only the files that are new or whose size/mtime changed since the cache was written get parsed.
+    # progress/cancel follow the parsing, see read_scan_files. Archives are read by load_archive.
+    if is_archive(directory):
+        return load_archive(directory, n_workers, min_x, max_x, progress, cancel)
+    file_list = list_scan_files(directory)
+    signatures = []
+    for fpath in file_list:
+        stat = os.stat(fpath)
+        signatures.append((os.path.split(fpath)[1], stat.st_size, stat.st_mtime_ns))
+    cached = None
+    if use_cache:
+        cached = read_run_cache(directory, min_x, max_x)
+    cached_ids = dict()
+    if cached is not None:
+        cached_files, arrays = cached
+        cached_ids = {tuple(entry[:3]): entry[3] for entry in cached_files}
+    stale = [fpath for fpath, signature in zip(file_list, signatures) if signature not in cached_ids]
+    parsed = dict(zip(stale, read_scan_files(stale, n_workers, min_x=min_x, max_x=max_x, progress=progress,
+                                             cancel=cancel)))
+
+    store = ScanStore(min_x, max_x)
+    if cached is not None and len(stale) == 0 and len(cached_files) == len(file_list):
+        files = cached_files
+        store.set_arrays(**arrays)
+    else:
+        files = []
+        cells, scans, wavelengths, x_list, y_list = [], [], [], [], []
+        for fpath, signature in zip(file_list, signatures):
+            abs_id = cached_ids.get(signature)
+            if abs_id is None:
+                file_scan = parsed.get(fpath)
+                if len(file_scan) == 0:
+                    files.append([*signature, -1])
+                    continue
+                _, cell, scan, wavelength, x_vals, y_vals = file_scan
+            elif abs_id < 0:
+                files.append([*signature, -1])
+                continue
+            else:
+                cell, scan, wavelength = arrays["cell"][abs_id], arrays["scan"][abs_id], arrays["wavelength"][abs_id]
+                offset, size = arrays["offsets"][abs_id], arrays["sizes"][abs_id]
+                x_vals = arrays["x_data"][offset: offset + size]
+                y_vals = arrays["y_data"][offset: offset + size]
+            files.append([*signature, len(x_list)])
+            cells.append(cell)
+            scans.append(scan)
+            wavelengths.append(wavelength)
+            x_list.append(x_vals)
+            y_list.append(y_vals)
+        store.append(cells, scans, wavelengths, x_list, y_list)
+
+    run_id = None
+    for f_name, _, _, abs_id in files:
+        if abs_id < 0:
+            continue
+        run_id_c = get_file_info(f_name)[0]
+        if run_id is None:
+            run_id = run_id_c
+        elif run_id != run_id_c:
+            raise ValueError(f"More than one run ID found:\n{run_id}\n{run_id_c}")
+    if use_cache and len(files) > 0 and (cached is None or files is not cached_files):
+        write_run_cache(directory, files, store, min_x, max_x)
+    store.files = file_list
+    return run_id, store
+
+
+class LazyScanStore(ScanStore):
+    # Index of a run built from the file names only. Scan arrays are parsed the first time they are needed
+    # and kept in a least-recently-used cache holding at most memory_limit bytes of points; evicted scans are
+    # parsed again when needed. Trim indices and group statistics outlive eviction. A region set on scans that
+    # are not loaded is kept in pending_min/max and trimmed when they are parsed.
+    def __init__(self, min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX, memory_limit: int = MEMORY_LIMIT,
+                 n_workers: int = None):
+        super().__init__(min_x, max_x)
+        self.memory_limit = memory_limit
+        self.n_workers = n_workers
+        self.file_paths = np.empty(0, dtype=object)
+        self.file_sizes = np.empty(0, dtype=np.int64)
+        self.resident = np.empty(0, dtype=bool)
+        self.valid = np.empty(0, dtype=bool)
+        self.pending_min = np.empty(0, dtype=np.float64)
+        self.pending_max = np.empty(0, dtype=np.float64)
+        self.lru = OrderedDict()
+        self.used_bytes = 0
+
+    def clear(self):
+        self.__init__(self.min_x, self.max_x, self.memory_limit, self.n_workers)
+
+    def add_files(self, file_list: list, n_workers: int = None):
+        # only indexes the files, n_workers is not needed until they are parsed
+        self.files.extend(file_list)
+        file_info = [get_file_info(os.path.split(fpath)[1]) for fpath in file_list]
+        file_list = [fpath for fpath, info in zip(file_list, file_info) if len(info) > 0]
+        file_info = [info for info in file_info if len(info) > 0]
+        n_new = len(file_list)
+        if n_new == 0:
+            return np.empty(0, dtype=np.int64)
+        abs_ids = np.arange(len(self), len(self) + n_new)
+        _, cells, scans, wavelengths = zip(*file_info)
+        file_paths = np.empty(n_new, dtype=object)
+        file_paths[:] = file_list
+        self.file_paths = np.concatenate([self.file_paths, file_paths])
+        self.file_sizes = np.concatenate([self.file_sizes, [os.path.getsize(fpath) for fpath in file_list]])
+        self.offsets = np.concatenate([self.offsets, np.zeros(n_new, dtype=np.int64)])
+        self.sizes = np.concatenate([self.sizes, np.zeros(n_new, dtype=np.int64)])
+        self.run = np.concatenate([self.run, np.zeros(n_new, dtype=np.int32)])
+        self.cell = np.concatenate([self.cell, np.asarray(cells, dtype=np.int32)])
+        self.wavelength = np.concatenate([self.wavelength, np.asarray(wavelengths, dtype=np.int32)])
+        self.scan = np.concatenate([self.scan, np.asarray(scans, dtype=np.int32)])
+        self.state = np.concatenate([self.state, np.ones(n_new, dtype=bool)])
+        self.min_id = np.concatenate([self.min_id, np.zeros(n_new, dtype=np.int64)])
+        self.max_id = np.concatenate([self.max_id, np.full(n_new, -1, dtype=np.int64)])  # -1: never parsed
+        self.resident = np.concatenate([self.resident, np.zeros(n_new, dtype=bool)])
+        self.valid = np.concatenate([self.valid, np.ones(n_new, dtype=bool)])
+        self.pending_min = np.concatenate([self.pending_min, np.full(n_new, np.nan)])
+        self.pending_max = np.concatenate([self.pending_max, np.full(n_new, np.nan)])
+        self.build_index()
+        self.dirty[self.group_id[abs_ids]] = True
+        return abs_ids
+
+    def is_valid(self, abs_ids):
+        # scans not parsed yet count as valid
+        return self.valid[np.asarray(abs_ids, dtype=np.int64)]
+
+    def last_scans(self, cell):
+        # highest numbered scan of each wavelength whose file can be parsed, as in memory; the picks are loaded
+        # to find out and the next scan down is tried for those that fail
+        groups = self.cell_groups(cell)
+        while True:
+            abs_ids = [self.group_scans(group) for group in groups]
+            abs_ids = np.array([group_ids[self.valid[group_ids]][-1] for group_ids in abs_ids
+                                if np.any(self.valid[group_ids])], dtype=np.int64)
+            self.load(abs_ids)
+            if np.all(self.valid[abs_ids]):
+                return abs_ids
+
+    def set_state(self, abs_ids, state):
+        # files that could not be parsed stay unchecked
+        super().set_state(abs_ids, np.logical_and(state, self.valid[abs_ids]))
+
+    def defer_trim(self, abs_ids, min_x, max_x):
+        abs_ids = np.asarray(abs_ids, dtype=np.int64)
+        resident = self.resident[abs_ids]
+        waiting = abs_ids[~resident]
+        self.pending_min[waiting] = np.broadcast_to(min_x, abs_ids.shape)[~resident]
+        self.pending_max[waiting] = np.broadcast_to(max_x, abs_ids.shape)[~resident]
+        self.pending_min[abs_ids[resident]] = np.nan
+        self.pending_max[abs_ids[resident]] = np.nan
+        self.dirty[self.group_id[waiting]] = True
+        return resident
+
+    def load(self, abs_ids):
+        abs_ids = np.unique(np.asarray(abs_ids, dtype=np.int64))
+        missing = abs_ids[~self.resident[abs_ids]]
+        if len(missing) > 0:
+            file_list = self.file_paths[missing].tolist()
+            file_scans = read_scan_files(file_list, self.n_workers, True, self.min_x, self.max_x)
+            sizes = np.array([len(file_scan[4]) if len(file_scan) > 0 else 0 for file_scan in file_scans],
+                             dtype=np.int64)
+            self.evict(int(np.sum(sizes)) * 16, abs_ids)
+            if len(self.x_data) + int(np.sum(sizes)) > len(self.x_buffer):
+                self.compact()
+            n_points = len(self.x_data)
+            n_total = n_points + int(np.sum(sizes))
+            self.reserve(n_total)
+            self.x_data = self.x_buffer[:n_total]
+            self.y_data = self.y_buffer[:n_total]
+            self.area_data = self.area_buffer[:n_total]
+            parsed = sizes > 0
+            if np.any(parsed):
+                np.concatenate([file_scan[4] for file_scan in file_scans if len(file_scan) > 0],
+                               out=self.x_data[n_points:])
+                np.concatenate([file_scan[5] for file_scan in file_scans if len(file_scan) > 0],
+                               out=self.y_data[n_points:])
+                self.add_areas(n_points)
+            offsets = np.zeros(len(missing), dtype=np.int64)
+            np.cumsum(sizes[:-1], out=offsets[1:])
+            self.offsets[missing] = offsets + n_points
+            self.sizes[missing] = sizes
+            self.resident[missing] = True
+            failed = missing[~parsed]
+            self.valid[failed] = False
+            self.set_state(failed, False)
+            new = missing[self.max_id[missing] < 0]
+            self.min_id[new] = 0
+            self.max_id[new] = self.sizes[new]
+            pending = missing[np.isfinite(self.pending_min[missing])]
+            self.set_trim(pending, *find_trim(self, pending, self.pending_min[pending], self.pending_max[pending]))
+            self.pending_min[pending] = np.nan
+            self.pending_max[pending] = np.nan
+            for abs_id, size in zip(missing.tolist(), sizes.tolist()):
+                self.lru[abs_id] = size * 16
+                self.used_bytes += size * 16
+        for abs_id in abs_ids.tolist():
+            self.lru.move_to_end(abs_id)
+
+    def evict(self, n_bytes: int, keep):
+        # drop the least recently used scans until n_bytes more fit within memory_limit
+        keep = set(np.asarray(keep).tolist())
+        evicted = []
+        for abs_id in list(self.lru.keys()):
+            if self.used_bytes + n_bytes <= self.memory_limit:
+                break
+            if abs_id in keep:
+                continue
+            self.used_bytes -= self.lru.pop(abs_id)
+            evicted.append(abs_id)
+        if len(evicted) == 0:
+            return
+        evicted = np.array(evicted, dtype=np.int64)
+        self.resident[evicted] = False
+        self.sizes[evicted] = 0
+        self.offsets[evicted] = 0
+
+    def reserve(self, n_points: int):
+        # the buffers hold memory_limit bytes of points (16 per point), more only when the scans being loaded
+        # need it, and never grow geometrically
+        if n_points <= len(self.x_buffer):
+            return
+        n_used = len(self.x_data)
+        capacity = max(n_points, self.memory_limit // 16)
+        x_buffer = np.empty(capacity, dtype=np.float32)
+        y_buffer = np.empty(capacity, dtype=np.float32)
+        area_buffer = np.empty(capacity, dtype=np.float64)
+        x_buffer[:n_used] = self.x_data
+        y_buffer[:n_used] = self.y_data
+        area_buffer[:n_used] = self.area_data
+        self.x_buffer, self.y_buffer, self.area_buffer = x_buffer, y_buffer, area_buffer
+        self.x_data, self.y_data, self.area_data = x_buffer[:n_used], y_buffer[:n_used], area_buffer[:n_used]
+
+    def compact(self):
+        # Moves the points of the loaded scans, in buffer order, to the front of the buffers, COMPACT_CHUNK
+        # points at a time: every scan moves down, so a chunk never overwrites points still to be moved. The
+        # running areas move along, the area of a scan being a difference within it.
+        abs_ids = np.flatnonzero(self.sizes > 0)
+        abs_ids = abs_ids[np.argsort(self.offsets[abs_ids], kind="stable")]
+        old_offsets = self.offsets[abs_ids]
+        sizes = self.sizes[abs_ids]
+        offsets = np.zeros(len(abs_ids), dtype=np.int64)
+        np.cumsum(sizes[:-1], out=offsets[1:])
+        n_total = int(np.sum(sizes))
+        chunks = np.searchsorted(offsets, np.arange(0, n_total, COMPACT_CHUNK), side="right") - 1
+        for first, last in zip(chunks.tolist(), [*chunks[1:].tolist(), len(abs_ids)]):
+            if last <= first:
+                continue
+            start, end = offsets[first], offsets[last - 1] + sizes[last - 1]
+            point_ids = np.arange(start, end) + np.repeat(old_offsets[first:last] - offsets[first:last],
+                                                          sizes[first:last])
+            self.x_buffer[start:end] = self.x_buffer[point_ids]
+            self.y_buffer[start:end] = self.y_buffer[point_ids]
+            self.area_buffer[start:end] = self.area_buffer[point_ids]
+        # the non-finite trapezoids within the moved scans move with them
+        scan_pos = np.searchsorted(old_offsets, self.nan_segments, side="right") - 1
+        inside = scan_pos >= 0
+        inside[inside] = self.nan_segments[inside] < old_offsets[scan_pos[inside]] + sizes[scan_pos[inside]] - 1
+        self.nan_segments = self.nan_segments[inside] - old_offsets[scan_pos[inside]] + offsets[scan_pos[inside]]
+        self.x_data, self.y_data = self.x_buffer[:n_total], self.y_buffer[:n_total]
+        self.area_data = self.area_buffer[:n_total]
+        self.offsets[abs_ids] = offsets
+
+    def loaded_batches(self, groups):
+        # groups are loaded a few at a time, so that each batch fits in half of the memory budget
+        batch = []
+        n_bytes = 0
+        for group in np.asarray(groups, dtype=np.int64).tolist():
+            group_bytes = int(np.sum(self.file_sizes[self.group_scans(group)]))
+            if len(batch) > 0 and n_bytes + group_bytes > self.memory_limit // 2:
+                self.load(np.concatenate([self.group_scans(group_id) for group_id in batch]))
+                yield np.array(batch, dtype=np.int64)
+                batch = []
+                n_bytes = 0
+            batch.append(group)
+            n_bytes += group_bytes
+        if len(batch) > 0:
+            self.load(np.concatenate([self.group_scans(group_id) for group_id in batch]))
+            yield np.array(batch, dtype=np.int64)
+
+
+def open_run(directory: str, memory_limit: int = MEMORY_LIMIT, n_workers: int = None,
+             min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX):
+    # lazy counterpart of load_run, no file is parsed here
+    file_list = list_scan_files(directory)
+    run_id = None
+    for fpath in file_list:
+        run_id_c = get_file_info(os.path.split(fpath)[1])[0]
+        if run_id is None:
+            run_id = run_id_c
+        elif run_id != run_id_c:
+            raise ValueError(f"More than one run ID found:\n{run_id}\n{run_id_c}")
+    store = LazyScanStore(min_x, max_x, memory_limit, n_workers)
+    store.add_files(file_list)
+    return run_id, store
+
+
+class Workspace(ScanStore):
+    # Several runs in one store. "run" indexes run_ids/directories and the cell keys are (run, cell) pairs,
+    # coded as run << 32 | cell, so regions, integrals and reports cover every run at once.
+    def __init__(self, min_x: float = RADIAL_MIN, max_x: float = RADIAL_MAX):
+        super().__init__(min_x, max_x)
+        self.run_ids = []
+        self.directories = []
+
+    def add_store(self, run_id: str, directory: str, store: ScanStore):
+        # copies the scans of a loaded run with their states and trims, returns its run index
+        if run_id in self.run_ids:
+            raise ValueError(f"Run {run_id} is already in the workspace")
+        run = len(self.run_ids)
+        self.run_ids.append(run_id)
+        self.directories.append(directory)
+        for groups in store.loaded_batches(np.arange(len(store.group_cell))):
+            abs_ids = np.concatenate([store.group_scans(group) for group in groups])
+            abs_ids = abs_ids[store.is_valid(abs_ids)]
+            new_ids = self.append(store.cell[abs_ids], store.scan[abs_ids], store.wavelength[abs_ids],
+                                  [store.x_values(abs_id) for abs_id in abs_ids],
+                                  [store.y_values(abs_id) for abs_id in abs_ids], np.full(len(abs_ids), run))
+            self.state[new_ids] = store.state[abs_ids]
+            self.min_id[new_ids] = store.min_id[abs_ids]
+            self.max_id[new_ids] = store.max_id[abs_ids]
+        return run
+
+    def add_directory(self, directory: str, n_workers: int = None, use_cache: bool = True, progress=None,
+                      cancel=None):
+        # adds every run of a directory (or archive) and returns their indices, runs sharing a directory bypass
+        # the cache
+        if is_archive(directory):
+            file_scans = read_archive(directory, n_workers, self.min_x, self.max_x, progress, cancel)[1]
+        else:
+            file_list = list_scan_files(directory)
+            run_ids = sorted({get_file_info(os.path.split(fpath)[1])[0] for fpath in file_list})
+            for run_id in run_ids:
+                if run_id in self.run_ids:
+                    raise ValueError(f"Run {run_id} is already in the workspace")
+            if len(run_ids) <= 1:
+                run_id, store = load_run(directory, n_workers, self.min_x, self.max_x, use_cache, progress, cancel)
+                if len(store) == 0:
+                    raise ValueError(f"No 'RA' files found in {directory}")
+                return [self.add_store(run_id, directory, store)]
+            file_scans = read_scan_files(file_list, n_workers, min_x=self.min_x, max_x=self.max_x,
+                                         progress=progress, cancel=cancel)
+        return self.add_scans(directory, file_scans)
+
+    def add_scans(self, directory: str, file_scans: list):
+        # adds every run of the read_scan_file results of a directory (or archive), returns their indices
+        file_scans = [file_scan for file_scan in file_scans if len(file_scan) > 0]
+        if len(file_scans) == 0:
+            raise ValueError(f"No 'RA' files found in {directory}")
+        file_runs, cells, scans, wavelengths, x_list, y_list = zip(*file_scans)
+        run_ids = sorted(set(file_runs))
+        for run_id in run_ids:
+            if run_id in self.run_ids:
+                raise ValueError(f"Run {run_id} is already in the workspace")
+        runs = dict()
+        for run_id in run_ids:
+            runs[run_id] = len(self.run_ids)
+            self.run_ids.append(run_id)
+            self.directories.append(directory)
+        self.append(cells, scans, wavelengths, x_list, y_list, [runs[run_id] for run_id in file_runs])
+        return list(runs.values())
+
+    def cell_code(self, cell):
+        return (int(cell[0]) << 32) | int(cell[1])
+
+    def code_key(self, code: int):
+        return int(code) >> 32, int(code) & 0xFFFFFFFF
+
+    def scan_codes(self, abs_ids):
+        return (self.run[abs_ids].astype(np.int64) << 32) | self.cell[abs_ids]
+
+    def group_codes(self):
+        return (self.group_run.astype(np.int64) << 32) | self.group_cell
+
+    def cell_name(self, cell):
+        return f"{self.run_ids[cell[0]]} / {cell[1]}"
+
+    def report_labels(self):
+        return {cell: f"{self.run_ids[cell[0]]}_Cell_{cell[1]}" for cell in self.cell_keys()}
+
+
+class RunWatcher:
+    # Polls a run directory for scan files that appeared after it was loaded. A new file is handed out once its
+    # size and mtime are unchanged between two polls or it is older than "settle" seconds, so scans the
+    # instrument is still writing are picked up later. "seen" lists the files already loaded (store.files),
+    # without it every file present now counts as loaded.
+    def __init__(self, directory: str, run_id: str = None, settle: float = 2.0, seen=None):
+        self.directory = directory
+        self.run_id = run_id
+        self.settle = settle
+        self.seen = set(list_scan_files(directory) if seen is None else seen)
+        self.pending = dict()
+
+    def poll(self):
+        ready = []
+        now = time.time()
+        for fpath in list_scan_files(self.directory):
+            if fpath in self.seen:
+                continue
+            try:
+                stat = os.stat(fpath)
+            except OSError:
+                continue  # removed again since the listing
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self.pending.get(fpath) == signature or now - stat.st_mtime > self.settle:
+                ready.append(fpath)
+                self.seen.add(fpath)
+                self.pending.pop(fpath, None)
+            else:
+                self.pending[fpath] = signature
+        for fpath in ready:
+            run_id_c = get_file_info(os.path.split(fpath)[1])[0]
+            if self.run_id is None:
+                self.run_id = run_id_c
+            elif self.run_id != run_id_c:
+                raise ValueError(f"More than one run ID found:\n{self.run_id}\n{run_id_c}")
+        return ready
+
+
+def checked_areas(store: ScanStore, groups):
+    # areas of the checked scans of the groups in "groups" with the position of their group in "groups",
+    # sorted by position, and their abs_ids
+    groups = np.asarray(groups, dtype=np.int64)
+    position = np.full(len(store.group_cell), -1, dtype=np.int64)
+    position[groups] = np.arange(len(groups))
+    abs_ids = store.order[store.state[store.order]]
+    group_pos = position[store.group_id[abs_ids]]
+    abs_ids = abs_ids[group_pos >= 0]
+    group_pos = group_pos[group_pos >= 0]
+    sort = np.argsort(group_pos, kind="stable")
+    return group_pos[sort], store.areas(abs_ids[sort]), abs_ids[sort]
+
+
+def area_noise(store: ScanStore, abs_ids):
+    # standard error of the area of each scan (within its trim) from the noise of its points, estimated from
+    # the differences of neighbouring absorbances: sqrt(sum(dy^2) / (2 (n - 1))) * sqrt(sum(dx^2)); band slopes
+    # add to it, so it errs on the high side. NaN for scans of fewer than two points.
+    abs_ids = np.asarray(abs_ids, dtype=np.int64)
+    starts = store.offsets[abs_ids] + store.min_id[abs_ids]
+    n_steps = np.maximum(store.max_id[abs_ids] - store.min_id[abs_ids] - 1, 0)
+    scan_pos = np.repeat(np.arange(len(abs_ids)), n_steps)
+    point_ids = np.arange(len(scan_pos)) + np.repeat(starts - (np.cumsum(n_steps) - n_steps), n_steps)
+    dx = (store.x_data[point_ids + 1] - store.x_data[point_ids]).astype(np.float64)
+    dy = (store.y_data[point_ids + 1] - store.y_data[point_ids]).astype(np.float64)
+    sum_dx = np.bincount(scan_pos, weights=dx ** 2, minlength=len(abs_ids))
+    sum_dy = np.bincount(scan_pos, weights=dy ** 2, minlength=len(abs_ids))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.sqrt(sum_dy / (2 * n_steps) * sum_dx)
+
+
+def integrate_groups(store: ScanStore, groups):
+    # mean and std of the areas of the checked scans of every group in "groups", in one pass
+    n_groups = len(groups)
+    group_pos, areas, _ = checked_areas(store, groups)
+    count = np.bincount(group_pos, minlength=n_groups)
+    divisor = np.maximum(count, 1)
+    mean = np.bincount(group_pos, weights=areas, minlength=n_groups) / divisor
+    variance = np.bincount(group_pos, weights=(areas - mean[group_pos]) ** 2, minlength=n_groups) / divisor
+    return mean, np.sqrt(variance), count
+
+
+def group_intervals(store: ScanStore, groups, method: str = "bootstrap", n_resamples: int = 1000,
+                    level: float = 0.95, seed: int = 0):
+    # Confidence interval (low, high) of the mean area of the checked scans of every group in "groups", NaN
+    # for groups without checked scans. "bootstrap" takes the percentiles of the means of n_resamples
+    # resamples drawn with replacement within each group; the draws of all groups come as one index array,
+    # BOOTSTRAP_CHUNK indices at a time. "jackknife" is the normal interval of the leave-one-out means, NaN
+    # below 2 scans. Sums are accumulated in float64.
+    n_groups = len(groups)
+    group_pos, areas, _ = checked_areas(store, groups)
+    count = np.bincount(group_pos, minlength=n_groups)
+    low = np.full(n_groups, np.nan)
+    high = np.full(n_groups, np.nan)
+    filled = count > 0
+    if not np.any(filled):
+        return low, high
+    if method == "jackknife":
+        sums = np.bincount(group_pos, weights=areas, minlength=n_groups)
+        filled = count > 1
+        inside = filled[group_pos]
+        pos = group_pos[inside]
+        leave_out = (sums[pos] - areas[inside]) / (count[pos] - 1)
+        divisor = np.maximum(count, 1)
+        jack_mean = np.bincount(pos, weights=leave_out, minlength=n_groups) / divisor
+        squares = np.bincount(pos, weights=(leave_out - jack_mean[pos]) ** 2, minlength=n_groups)
+        half = NormalDist().inv_cdf(0.5 + level / 2) * np.sqrt(squares * (count - 1) / divisor)
+        mean = sums / divisor
+        low[filled] = (mean - half)[filled]
+        high[filled] = (mean + half)[filled]
+        return low, high
+    if method != "bootstrap":
+        raise ValueError(f"Unknown interval method: {method}")
+    rng = np.random.default_rng(seed)
+    starts = np.cumsum(count) - count
+    first = starts[group_pos]
+    sizes = count[group_pos]
+    means = np.full((n_resamples, n_groups), np.nan)
+    n_rows = max(1, BOOTSTRAP_CHUNK // len(areas))
+    for row in range(0, n_resamples, n_rows):
+        chunk = min(n_rows, n_resamples - row)
+        draws = first + rng.integers(sizes, size=(chunk, len(areas)))
+        means[row: row + chunk, filled] = np.add.reduceat(areas[draws], starts[filled], axis=1) / count[filled]
+    low[filled], high[filled] = np.quantile(means[:, filled], [0.5 - level / 2, 0.5 + level / 2], axis=0)
+    return low, high
+
+
+def update_integrals(store: ScanStore, groups, interval: dict = None, progress=None, cancel=None):
+    # integrate the dirty groups among "groups" into the store's group cache and return them, with their
+    # confidence intervals when interval holds the group_intervals settings; new settings make every group
+    # dirty. progress(done, total) counts the groups, a cancelled update leaves every group dirty
+    groups = np.asarray(groups, dtype=np.int64)
+    if interval != store.interval:
+        store.interval = interval
+        store.dirty[:] = True
+        store.group_low[:] = np.nan
+        store.group_high[:] = np.nan
+    dirty = groups[store.dirty[groups]]
+    if len(dirty) > 0:
+        with profiler.stage("integrate", len(dirty)):
+            n_done = 0
+            for batch in store.loaded_batches(dirty):
+                check_cancel(cancel)
+                mean, std, count = integrate_groups(store, batch)
+                n_done += len(batch)
+                if progress is not None:
+                    progress(n_done, len(dirty))
+                store.group_mean[batch] = mean
+                store.group_std[batch] = std
+                store.group_count[batch] = count
+                if interval is not None:
+                    store.group_low[batch], store.group_high[batch] = group_intervals(store, batch, **interval)
+            store.dirty[dirty] = False
+    return dirty
+
+
+def robust_scores(values, group_pos, n_groups: int, min_count: int = OUTLIER_MIN_SCANS, floor: float = 0.0,
+                  noise=None):
+    # (value - median) / (1.4826 * MAD) of every value within its group, so about a z-score for normal values;
+    # the medians of all groups come from one sort. The spread is at least floor * |median| and the group median
+    # of noise (the standard error of each value, when given): the MAD of a few values is often far below their
+    # true spread, and tightly bunched values must not make tiny differences score high. Non-finite values score
+    # inf and are left out of the statistics, groups with fewer than min_count finite values score NaN.
+    values = np.asarray(values, dtype=np.float64)
+    scores = np.full(len(values), np.inf)
+    finite = np.flatnonzero(np.isfinite(values))
+    pos = group_pos[finite]
+    count = np.bincount(pos, minlength=n_groups)
+    starts = np.cumsum(count) - count
+    filled = count > 0
+    low = (starts + (count - 1) // 2)[filled]
+    high = (starts + count // 2)[filled]
+
+    def group_medians(group_values):
+        sorted_values = group_values[np.lexsort((group_values, pos))]
+        medians = np.full(n_groups, np.nan)
+        medians[filled] = (sorted_values[low] + sorted_values[high]) / 2
+        return medians
+
+    medians = group_medians(values[finite])[pos]
+    deviation = values[finite] - medians
+    spread = np.maximum(1.4826 * group_medians(np.abs(deviation))[pos], floor * np.abs(medians))
+    if noise is not None:
+        spread = np.maximum(spread, group_medians(np.nan_to_num(noise[finite]))[pos])
+    scores[finite] = deviation / np.maximum(spread, np.finfo(np.float64).tiny)
+    scores[finite[count[pos] < min_count]] = np.nan
+    return scores
+
+
+def find_outliers(store: ScanStore, groups=None, threshold: float = OUTLIER_THRESHOLD, profiles: bool = False,
+                  progress=None, cancel=None):
+    # Screens the checked scans of the groups (all by default) for outliers, whose area (within their trim)
+    # has a robust score (robust_scores) beyond +-threshold within its group. With profiles, scans whose
+    # profile strays from the median profile of the group are outliers too: the scans are aligned on one grid
+    # (align_scans), and the RMS deviation within the trim of each scan scores above threshold, its spread kept
+    # above OUTLIER_PROFILE_FLOOR times the median RMS deviation of the group (the noise of a clean scan); groups
+    # with fewer than OUTLIER_MIN_PROFILES checked scans only have their areas screened. Returns the
+    # abs_ids of the outliers with their area and profile scores (NaN without profiles); the states are left
+    # to the caller. progress(done, total) counts the groups.
+    if groups is None:
+        groups = np.arange(len(store.group_cell))
+    groups = np.asarray(groups, dtype=np.int64)
+    outliers, area_scores, profile_scores = [], [], []
+    n_done = 0
+    with profiler.stage("find_outliers", len(groups)):
+        for batch in store.loaded_batches(groups):
+            check_cancel(cancel)
+            group_pos, areas, abs_ids = checked_areas(store, batch)
+            area_score = robust_scores(areas, group_pos, len(batch), noise=area_noise(store, abs_ids))
+            profile_score = np.full(len(abs_ids), np.nan)
+            if profiles and len(abs_ids) > 0:
+                grid, block, _ = align_scans(store, abs_ids)
+                offsets = store.offsets[abs_ids]
+                min_x = store.x_data[offsets + store.min_id[abs_ids]]
+                max_x = store.x_data[offsets + np.maximum(store.max_id[abs_ids], store.min_id[abs_ids] + 1) - 1]
+                block[np.logical_or(grid < min_x[:, None], grid > max_x[:, None])] = np.nan
+                count = np.bincount(group_pos, minlength=len(batch))
+                scan_pos = np.arange(len(abs_ids)) - np.repeat(np.cumsum(count) - count, count)
+                cube = np.full((len(batch), int(np.max(count)), len(grid)), np.nan, dtype=np.float32)
+                cube[group_pos, scan_pos] = block
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", RuntimeWarning)  # radii or scans without a finite value
+                    median_profile = np.nanmedian(cube, axis=1)
+                    deviation = np.sqrt(np.nanmean((block - median_profile[group_pos]) ** 2, axis=1))
+                profile_score = robust_scores(deviation, group_pos, len(batch), OUTLIER_MIN_PROFILES,
+                                              OUTLIER_PROFILE_FLOOR)
+            outlier = np.logical_or(np.abs(area_score) > threshold, profile_score > threshold)
+            outliers.append(abs_ids[outlier])
+            area_scores.append(area_score[outlier])
+            profile_scores.append(profile_score[outlier])
+            n_done += len(batch)
+            if progress is not None:
+                progress(n_done, len(groups))
+    if len(outliers) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+    return np.concatenate(outliers), np.concatenate(area_scores), np.concatenate(profile_scores)
+
+
+def stack_radii(store: ScanStore, abs_ids, bounds):
+    # The radii of the scans (at least one point in all) in one sorted float64 array: scan k is shifted by
+    # k * span, a power of two wider than any radius or bound, so the shifted radii stay exact and sorted and a
+    # bound shifted like its scan falls within it. Returns the radii, their point indices and the first
+    # position and shift of each scan.
+    sizes = store.sizes[abs_ids]
+    starts = np.zeros(len(abs_ids), dtype=np.int64)
+    np.cumsum(sizes[:-1], out=starts[1:])
+    point_ids = np.arange(int(np.sum(sizes))) + np.repeat(store.offsets[abs_ids] - starts, sizes)
+    x_vals = store.x_data[point_ids].astype(np.float64)
+    base = np.floor(min(np.min(x_vals), np.min(bounds)))
+    span = 2.0 ** np.ceil(np.log2(max(np.max(x_vals), np.max(bounds)) - base + 1))
+    shift = np.arange(len(abs_ids)) * span - base
+    x_vals += np.repeat(shift, sizes)
+    return x_vals, point_ids, starts, shift
+
+
+def find_trim(store: ScanStore, abs_ids, min_x, max_x):
+    # trim indices [min_id, max_id) of the points of each scan within [min_x, max_x], min_x/max_x are scalars or
+    # per-scan arrays; scans with fewer than 10 points in the window are not trimmed.
+    # The radii of all scans are searched at once, see stack_radii.
+    abs_ids = np.asarray(abs_ids, dtype=np.int64)
+    sizes = store.sizes[abs_ids]
+    min_ids = np.zeros(len(abs_ids), dtype=np.int64)
+    max_ids = sizes.copy()
+    if int(np.sum(sizes)) == 0:
+        return min_ids, max_ids
+    # bounds are compared in float32 like the radii
+    min_x = np.broadcast_to(np.float32(min_x), abs_ids.shape).astype(np.float64)
+    max_x = np.broadcast_to(np.float32(max_x), abs_ids.shape).astype(np.float64)
+    x_vals, _, starts, shift = stack_radii(store, abs_ids, np.concatenate([min_x, max_x]))
+    first = np.searchsorted(x_vals, min_x + shift, side="left")
+    last = np.searchsorted(x_vals, max_x + shift, side="right")
+    # scans whose radii are not increasing are masked one by one
+    unsorted = np.unique(np.searchsorted(starts, np.flatnonzero(np.diff(x_vals) < 0), side="right") - 1)
+    for i in unsorted.tolist():
+        x_val = store.x_values(abs_ids[i])
+        trim_ids = np.flatnonzero(np.logical_and(x_val >= min_x[i], x_val <= max_x[i]))
+        first[i] = last[i] = starts[i]
+        if len(trim_ids) > 0:
+            first[i], last[i] = starts[i] + trim_ids[0], starts[i] + trim_ids[-1] + 1
+    trimmed = last - first >= 10
+    min_ids[trimmed] = first[trimmed] - starts[trimmed]
+    max_ids[trimmed] = last[trimmed] - starts[trimmed]
+    return min_ids, max_ids
+
+
+def grid_keys(store: ScanStore, abs_ids):
+    # one int64 per scan, equal for the scans with the same number of points and first and last radius to 3
+    # decimals, so those that pass compare_x_array with each other; -1 for scans without points
+    abs_ids = np.asarray(abs_ids, dtype=np.int64)
+    sizes = store.sizes[abs_ids]
+    keys = np.full(len(abs_ids), -1, dtype=np.int64)
+    filled = sizes > 0
+    offsets = store.offsets[abs_ids[filled]]
+    first = np.rint(store.x_data[offsets] * np.float32(1000)).astype(np.int64)
+    last = np.rint(store.x_data[offsets + sizes[filled] - 1] * np.float32(1000)).astype(np.int64)
+    keys[filled] = (sizes[filled] << 32) | (first << 16) | last
+    return keys
+
+
+def resample(store: ScanStore, abs_ids, grid):
+    # absorbance of each scan linearly interpolated at the radii of grid, one float32 row per scan, NaN outside
+    # the scan; the scans are interpolated together, ALIGN_CHUNK at a time, over their stacked radii
+    abs_ids = np.asarray(abs_ids, dtype=np.int64)
+    grid = np.asarray(grid, dtype=np.float64)
+    block = np.full((len(abs_ids), len(grid)), np.nan, dtype=np.float32)
+    rows = np.flatnonzero(store.sizes[abs_ids] >= 2)
+    if len(grid) == 0:
+        return block
+    for chunk in range(0, len(rows), ALIGN_CHUNK):
+        chunk_rows = rows[chunk: chunk + ALIGN_CHUNK]
+        chunk_ids = abs_ids[chunk_rows]
+        sizes = store.sizes[chunk_ids]
+        x_vals, point_ids, starts, shift = stack_radii(store, chunk_ids, grid)
+        targets = grid[None, :] + shift[:, None]
+        lower = np.searchsorted(x_vals, targets, side="right") - 1
+        lower = np.clip(lower, starts[:, None], (starts + sizes - 2)[:, None])
+        x_0, x_1 = x_vals[lower], x_vals[lower + 1]
+        y_0, y_1 = store.y_data[point_ids[lower]], store.y_data[point_ids[lower + 1]]
+        d_x = x_1 - x_0
+        weight = np.divide(targets - x_0, d_x, out=np.zeros_like(d_x), where=d_x > 0)
+        inside = np.logical_and(targets >= x_vals[starts][:, None], targets <= x_vals[starts + sizes - 1][:, None])
+        block[chunk_rows] = np.where(inside, y_0 + weight * (y_1 - y_0), np.nan)
+    return block
+
+
+def align_scans(store: ScanStore, abs_ids, grid=None):
+    # Dense (scan x radius) block of the scans. The scans on the grid (compare_x_array against it) are copied
+    # as they are and the others are resampled onto it; the scans sharing a grid_keys key are compared once,
+    # through one of them. grid defaults to the radii of a scan of the most common grid. Returns the grid, the
+    # float32 block and the mask of the copied rows.
+    abs_ids = np.asarray(abs_ids, dtype=np.int64)
+    store.load(abs_ids)
+    keys = grid_keys(store, abs_ids)
+    if grid is None:
+        if not np.any(keys >= 0):
+            return np.empty(0), np.empty((len(abs_ids), 0), dtype=np.float32), np.zeros(len(abs_ids), dtype=bool)
+        values, counts = np.unique(keys[keys >= 0], return_counts=True)
+        grid = store.x_values(abs_ids[np.argmax(keys == values[np.argmax(counts)])])
+    else:
+        grid = np.asarray(grid, dtype=np.float32)
+    values, rows = np.unique(keys, return_index=True)
+    on_grid = [key for key, row in zip(values.tolist(), rows.tolist())
+               if key >= 0 and len(grid) > 0 and compare_x_array(grid, store.x_values(abs_ids[row]))]
+    exact = np.isin(keys, on_grid)
+    block = np.empty((len(abs_ids), len(grid)), dtype=np.float32)
+    rows = np.flatnonzero(exact)
+    block[rows] = store.y_data[store.offsets[abs_ids[rows]][:, None] + np.arange(len(grid))]
+    rows = np.flatnonzero(~exact)
+    block[rows] = resample(store, abs_ids[rows], grid)
+    return np.asarray(grid, dtype=np.float64), block, exact
+
+
+def cell_block(store: ScanStore, cell, grid=None):
+    # (wavelength x scan x radius) block of a cell aligned with align_scans, with the wavelengths, the grid and
+    # the (wavelength x scan) abs_ids; wavelengths with fewer scans are padded with NaN rows and abs_id -1.
+    # The groups are aligned batch after batch (loaded_batches) on the grid of the first one, so a lazy store
+    # keeps within its memory budget.
+    groups = store.cell_groups(cell)
+    counts = store.group_offsets[groups + 1] - store.group_offsets[groups]
+    scan_ids = np.full((len(groups), int(np.max(counts, initial=0))), -1, dtype=np.int64)
+    cube = None
+    n_done = 0
+    for batch in store.loaded_batches(groups):
+        abs_ids = np.concatenate([store.group_scans(group) for group in batch])
+        grid, block, _ = align_scans(store, abs_ids, grid)
+        if cube is None:
+            cube = np.full((*scan_ids.shape, len(grid)), np.nan, dtype=np.float32)
+        batch_counts = counts[n_done: n_done + len(batch)]
+        group_pos = np.repeat(np.arange(n_done, n_done + len(batch)), batch_counts)
+        scan_pos = np.arange(len(abs_ids)) - np.repeat(np.cumsum(batch_counts) - batch_counts, batch_counts)
+        scan_ids[group_pos, scan_pos] = abs_ids
+        cube[group_pos, scan_pos] = block
+        n_done += len(batch)
+    if cube is None:
+        grid = np.empty(0)
+        cube = np.full((*scan_ids.shape, 0), np.nan, dtype=np.float32)
+    return store.group_wavelength[groups], grid, scan_ids, cube
+
+
+def detect_regions(store: ScanStore, cells=None, threshold: float = EDGE_THRESHOLD, margin: float = EDGE_MARGIN):
+    # Proposes a region for each cell (all by default) between its meniscus and its bottom, which show as
+    # steps far steeper than the noise or the sample bands. The last scans of all cells are aligned on one
+    # grid (align_scans) and |dA/dr| is scaled by its robust spread (MAD) in each scan; radii where the median
+    # over the scans of a cell exceeds threshold are edges. The region spans from the first cluster of edges
+    # (meniscus) to the last one (bottom), so the flanks of a band never split it, narrowed by margin (cm) at
+    # both ends. Returns {cell key: [min_x, max_x]} for the cells where one is found.
+    cells = list(store.cell_keys() if cells is None else cells)
+    abs_ids = [store.last_scans(cell) for cell in cells]
+    counts = np.array([len(cell_ids) for cell_ids in abs_ids], dtype=np.int64)
+    regions = dict()
+    if np.sum(counts) == 0:
+        return regions
+    with profiler.stage("detect_regions", len(cells)):
+        grid, block, _ = align_scans(store, np.concatenate(abs_ids))
+        if len(grid) < 3:
+            return regions
+        slope = np.abs(np.gradient(block.astype(np.float64), grid, axis=1))
+        cube = np.full((len(cells), int(np.max(counts)), len(grid)), np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # scans or radii without a finite value
+            spread = np.nanmedian(np.abs(slope - np.nanmedian(slope, axis=1, keepdims=True)), axis=1, keepdims=True)
+            cell_pos = np.repeat(np.arange(len(cells)), counts)
+            scan_pos = np.arange(len(cell_pos)) - np.repeat(np.cumsum(counts) - counts, counts)
+            cube[cell_pos, scan_pos] = slope / np.maximum(1.4826 * spread, np.finfo(np.float64).tiny)
+            score = np.nanmedian(cube, axis=1)
+        # edges closer than margin form one cluster; the meniscus is the cluster nearest the low radii and the
+        # bottom the one nearest the high radii, whatever bands lie between them
+        for row, edges in enumerate(score > threshold):
+            edge_pos = np.flatnonzero(edges)
+            breaks = np.flatnonzero(np.diff(grid[edge_pos]) > margin)
+            if len(breaks) == 0:
+                continue
+            start, end = edge_pos[breaks[0]] + 1, edge_pos[breaks[-1] + 1]
+            low, high = grid[start] + margin, grid[end - 1] - margin
+            if end - start >= 10 and high > low:
+                regions[cells[row]] = [round(float(low), 4), round(float(high), 4)]
+    return regions
+
+
+def trim_region(store: ScanStore, abs_ids, min_x, max_x):
+    abs_ids = np.asarray(abs_ids, dtype=np.int64)
+    min_x = np.broadcast_to(np.asarray(min_x, dtype=np.float64), abs_ids.shape)
+    max_x = np.broadcast_to(np.asarray(max_x, dtype=np.float64), abs_ids.shape)
+    with profiler.stage("apply_region", len(abs_ids)):
+        now = store.defer_trim(abs_ids, min_x, max_x)
+        store.set_trim(abs_ids[now], *find_trim(store, abs_ids[now], min_x[now], max_x[now]))
+
+
+def apply_regions(store: ScanStore, regions, abs_ids=None):
+    # trims the scans (all of them by default) in one pass, regions is either one [min_x, max_x] for every cell
+    # or a {cell key: [min_x, max_x]} table; scans of cells without a region are left as they are
+    if not isinstance(regions, dict):
+        regions = dict.fromkeys(store.cell_keys(), regions)
+    keys = [key for key, region in regions.items() if region is not None and None not in region]
+    if abs_ids is None:
+        abs_ids = np.arange(len(store), dtype=np.int64)
+    abs_ids = np.asarray(abs_ids, dtype=np.int64)
+    if len(keys) == 0 or len(abs_ids) == 0:
+        return
+    codes = np.array([store.cell_code(key) for key in keys], dtype=np.int64)
+    table = np.array([regions[key] for key in keys], dtype=np.float64)[np.argsort(codes)]
+    codes = np.sort(codes)
+    scan_codes = store.scan_codes(abs_ids)
+    inside = np.isin(scan_codes, codes)
+    rows = np.searchsorted(codes, scan_codes[inside])
+    trim_region(store, abs_ids[inside], table[rows, 0], table[rows, 1])
+
+
+def update_cell_integrals(store: ScanStore, cell_minmax: dict, cell_integral: dict, interval: dict = None,
+                          progress=None, cancel=None):
+    # refresh cell_integral ([wavelength, mean, std] per cell key, then low and high with an interval, see
+    # update_integrals) for the cells whose groups are dirty, only cells with a region are integrated;
+    # returns those cells
+    region_cells = [cell for cell in store.cell_keys() if None not in cell_minmax.get(cell, [None])]
+    group_codes = store.group_codes()
+    groups = np.flatnonzero(np.isin(group_codes, [store.cell_code(cell) for cell in region_cells]))
+    dirty = update_integrals(store, groups, interval, progress, cancel)
+    for code in np.unique(group_codes[dirty]).tolist():
+        cell = store.code_key(code)
+        cell_ids = store.cell_groups(cell)
+        cell_ids = cell_ids[store.group_count[cell_ids] > 0]
+        if len(cell_ids) == 0:
+            cell_integral[cell] = None
+            continue
+        wavelength_vec = store.group_wavelength[cell_ids].astype(np.float32)
+        integral_vec = store.group_mean[cell_ids].astype(np.float32)
+        std_vec = store.group_std[cell_ids].astype(np.float32)
+        cell_integral[cell] = [wavelength_vec, integral_vec, std_vec]
+        if interval is not None:
+            cell_integral[cell] += [store.group_low[cell_ids].astype(np.float32),
+                                    store.group_high[cell_ids].astype(np.float32)]
+    return region_cells
+
+
+def read_spectra(file_path: str):
+    # reference spectra from a CSV file: a header row naming the columns, then one row per wavelength (nm)
+    # with the absorbance of each component; returns the sorted wavelengths, the component names and the
+    # (wavelength x component) spectra
+    with open(file_path) as fid:
+        header = fid.readline().split(",")
+        values = np.loadtxt(fid, delimiter=",", ndmin=2)
+    if values.shape[1] < 2 or len(values) < 2:
+        raise ValueError(f"No reference spectra found in {file_path}")
+    order = np.argsort(values[:, 0])
+    names = [name.strip() for name in header[1: values.shape[1]]]
+    names += [f"Component_{j}" for j in range(len(names) + 1, values.shape[1])]
+    return values[order, 0], names, values[order, 1:]
+
+
+def fit_spectra(cell_integral: dict, wavelengths, spectra, non_negative: bool = False,
+                n_iterations: int = FIT_ITERATIONS):
+    # Fits the OD of every cell as a combination of reference spectra (the columns of "spectra" at
+    # "wavelengths"), interpolated onto the wavelengths of the cell, which are left out beyond the references.
+    # All cells are solved at once as a stack of least-squares problems weighted by 1/STD (STD of 0 counts
+    # as the median STD), through a batched pseudo-inverse; non_negative refines the clipped solution by
+    # projected gradient descent. Returns {cell: [coefficients, fitted OD, residuals]}, NaN where left out.
+    cells = [cell for cell, val in cell_integral.items() if val is not None]
+    cell_fit = dict()
+    if len(cells) == 0:
+        return cell_fit
+    n_rows = np.array([len(cell_integral[cell][0]) for cell in cells], dtype=np.int64)
+    cell_pos = np.repeat(np.arange(len(cells)), n_rows)
+    row_pos = np.arange(len(cell_pos)) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+    wavelength_vec, od_vec, std_vec = [np.concatenate([cell_integral[cell][i] for cell in cells]).astype(np.float64)
+                                       for i in range(3)]
+    columns = np.column_stack([np.interp(wavelength_vec, wavelengths, spectrum, left=np.nan, right=np.nan)
+                               for spectrum in np.asarray(spectra, dtype=np.float64).T])
+    used = np.logical_and(np.all(np.isfinite(columns), axis=1), np.isfinite(od_vec))
+    positive = std_vec[std_vec > 0]
+    floor = np.median(positive) if len(positive) > 0 else 1.0
+    weight_vec = np.where(used, 1 / np.where(std_vec > 0, std_vec, floor), 0)
+    design = np.zeros((len(cells), int(np.max(n_rows)), columns.shape[1]))
+    design[cell_pos, row_pos] = np.where(used[:, None], columns, 0)
+    target = np.zeros(design.shape[:2])
+    target[cell_pos, row_pos] = np.where(used, od_vec, 0) * weight_vec
+    weighted = np.zeros_like(design)
+    weighted[cell_pos, row_pos] = design[cell_pos, row_pos] * weight_vec[:, None]
+    coefficients = (np.linalg.pinv(weighted) @ target[..., None])[..., 0]
+    if non_negative:
+        gram = weighted.transpose(0, 2, 1) @ weighted
+        rhs = (weighted.transpose(0, 2, 1) @ target[..., None])[..., 0]
+        step = 1 / np.maximum(np.linalg.eigvalsh(gram)[:, -1:], np.finfo(np.float64).tiny)
+        coefficients = np.maximum(coefficients, 0)
+        for _ in range(n_iterations):
+            update = np.maximum(coefficients - step * ((gram @ coefficients[..., None])[..., 0] - rhs), 0)
+            change = np.max(np.abs(update - coefficients))
+            coefficients = update
+            if change <= FIT_TOLERANCE * max(np.max(np.abs(coefficients)), np.finfo(np.float64).tiny):
+                break
+    fitted = np.where(used, (design @ coefficients[..., None])[cell_pos, row_pos, 0], np.nan)
+    residuals = od_vec - fitted
+    for i, cell in enumerate(cells):
+        rows = cell_pos == i
+        cell_fit[cell] = [coefficients[i], fitted[rows].astype(np.float32), residuals[rows].astype(np.float32)]
+    return cell_fit
+
+
+def format_column(values):
+    # CSV text of a column, floats in their shortest repr and NaN as an empty field
+    values = np.asarray(values)
+    if values.dtype.kind == "f":
+        return np.where(np.isnan(values), "", values.astype(str))
+    if values.dtype.kind == "b":
+        values = values.astype(np.int8)
+    return values.astype(str)
+
+
+def report_columns(cell_integral: dict, labels: dict = None):
+    # per-cell lambda/OD/STD (and CI_low/CI_high with intervals) columns stacked side by side, shorter cells
+    # padded with NaN; labels maps the cell keys to the column prefixes, Cell_<cell> by default.
+    # n_rows is the row count of each column
+    cells = [cell for cell, val in cell_integral.items() if val is not None]
+    n_columns = max([len(cell_integral[cell]) for cell in cells], default=3)
+    n_rows = np.array([len(cell_integral[cell][0]) for cell in cells], dtype=np.int64)
+    table = np.full((int(np.max(n_rows, initial=0)), n_columns * len(cells)), np.nan, dtype=np.float32)
+    for i, cell in enumerate(cells):
+        columns = np.column_stack(cell_integral[cell])
+        table[:n_rows[i], n_columns * i: n_columns * i + columns.shape[1]] = columns
+    if labels is None:
+        labels = {cell: f"Cell_{cell}" for cell in cells}
+    column_names = ("lambda", "OD", "STD", "CI_low", "CI_high")[:n_columns]
+    names = [f"{labels[cell]}_{name}" for cell in cells for name in column_names]
+    return names, table, np.repeat(n_rows, n_columns)
+
+
+def write_report(file_name: str, cell_integral: dict, labels: dict = None):
+    names, table, n_rows = report_columns(cell_integral, labels)
+    with profiler.stage("report", len(table)):
+        if os.path.splitext(file_name)[1].lower() != ".csv":
+            with TableWriter(file_name) as writer:
+                writer.write(dict(zip(names, table.T)))
+            return
+        columns = []
+        for j in range(table.shape[1]):
+            text = np.full(len(table), "", dtype=object)
+            values = table[:n_rows[j], j]
+            text[:len(values)] = values.astype(str) if names[j].endswith("_lambda") else np.char.mod("%.8f", values)
+            columns.append(text)
+        with open(file_name, 'w') as fid:
+            fid.write(",".join(names) + "\n")
+            fid.writelines(",".join(row) + "\n" for row in zip(*columns))
+
+
+def scan_table(store: ScanStore, cell_minmax: dict):
+    # one row per scan in (cell, wavelength, scan) order with its state, region and integral
+    area = np.full(len(store), np.nan)
+    for groups in store.loaded_batches(np.arange(len(store.group_cell))):
+        abs_ids = np.concatenate([store.group_scans(group) for group in groups])
+        area[abs_ids] = store.areas(abs_ids)
+    min_x = np.full(len(store), np.nan)
+    max_x = np.full(len(store), np.nan)
+    scan_codes = store.scan_codes(np.arange(len(store)))
+    for cell, region in cell_minmax.items():
+        if region is not None and None not in region:
+            inside = scan_codes == store.cell_code(cell)
+            min_x[inside], max_x[inside] = region
+    order = store.order[store.is_valid(store.order)]
+    table = {"cell": store.cell[order], "wavelength": store.wavelength[order], "scan": store.scan[order],
+             "state": store.state[order], "min_x": min_x[order], "max_x": max_x[order], "area": area[order]}
+    if isinstance(store, Workspace):
+        table = {"run": np.array(store.run_ids)[store.run[order]], **table}
+    return table
+
+
+def fit_table(cell_fit: dict, names: list, labels: dict = None):
+    # one row per fitted cell with its coefficients and the RMS of its residuals, labels as in report_columns
+    cells = list(cell_fit)
+    if labels is None:
+        labels = {cell: f"Cell_{cell}" for cell in cells}
+    coefficients = np.array([cell_fit[cell][0] for cell in cells]).reshape(len(cells), len(names))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # cells without a fitted wavelength
+        rms = np.array([np.sqrt(np.nanmean(cell_fit[cell][2].astype(np.float64) ** 2)) for cell in cells])
+    table = {"cell": np.array([labels[cell] for cell in cells], dtype=str)}
+    table.update({name: coefficients[:, j] for j, name in enumerate(names)})
+    table["rms"] = rms
+    return table
+
+
+class TableWriter:
+    # Writes a table of equal-length columns ({name: array}) chunk by chunk, so tables of many runs are
+    # streamed to disk. The format follows the extension of file_name (see REPORT_FORMATS); the NPZ
+    # columns are spooled to temporary files and concatenated into the archive on close.
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.format = os.path.splitext(file_name)[1].lower()
+        if self.format not in REPORT_FORMATS:
+            raise ValueError(f"Unsupported report format: {self.format}")
+        self.fid = None
+        self.chunks = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, columns: dict):
+        if self.format == ".csv":
+            if self.fid is None:
+                self.fid = open(self.file_name, 'w')
+                self.fid.write(",".join(columns) + "\n")
+            text = [format_column(values) for values in columns.values()]
+            self.fid.writelines(",".join(row) + "\n" for row in zip(*text))
+        elif self.format == ".npz":
+            for name, values in columns.items():
+                values = np.ascontiguousarray(values)
+                if name not in self.chunks:
+                    self.chunks[name] = (tempfile.TemporaryFile(), [])
+                spool, dtypes = self.chunks[name]
+                spool.write(values.tobytes())
+                dtypes.append((values.dtype, len(values)))
+        elif self.format == ".parquet":
+            table = pyarrow.table({name: np.asarray(values) for name, values in columns.items()})
+            if self.fid is None:
+                self.fid = pyarrow.parquet.ParquetWriter(self.file_name, table.schema)
+            self.fid.write_table(table)
+        else:
+            if self.fid is None:
+                self.fid = h5py.File(self.file_name, 'w')
+            for name, values in columns.items():
+                values = np.asarray(values)
+                if values.dtype.kind == "U":
+                    values = values.astype(object)
+                    dtype = h5py.string_dtype()
+                else:
+                    dtype = values.dtype
+                if name not in self.fid:
+                    self.fid.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True)
+                dataset = self.fid[name]
+                dataset.resize((len(dataset) + len(values),))
+                dataset[len(dataset) - len(values):] = values
+
+    def close(self):
+        if self.format == ".npz":
+            with zipfile.ZipFile(self.file_name, 'w', allowZip64=True) as archive:
+                for name, (spool, dtypes) in self.chunks.items():
+                    # chunks of different dtypes (e.g. string widths) are converted to a common one
+                    dtype = np.result_type(*[chunk_dtype for chunk_dtype, _ in dtypes])
+                    header = {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False,
+                              "shape": (sum(n for _, n in dtypes),)}
+                    spool.seek(0)
+                    with archive.open(name + ".npy", 'w', force_zip64=True) as member:
+                        np.lib.format.write_array_header_1_0(member, header)
+                        for chunk_dtype, n in dtypes:
+                            values = spool.read(n * chunk_dtype.itemsize)
+                            if chunk_dtype != dtype:
+                                values = np.frombuffer(values, dtype=chunk_dtype).astype(dtype).tobytes()
+                            member.write(values)
+                    spool.close()
+            self.chunks.clear()
+        elif self.fid is not None:
+            self.fid.close()
+        self.fid = None
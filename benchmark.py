@@ -0,0 +1,159 @@
+"""Benchmarks of the absorbance pipeline on synthetic runs.
+
+    python benchmark.py [-s small medium large] [-o benchmark.json] [-j JOBS] [--keep DIR]
+
+A run of each scale is written to a temporary directory (or DIR with --keep) and every stage is timed
+on its own: parse_file over all files, load_data indexing (ScanStore.append), load_run with its worker
+pool and no cache, apply_region on every cell, the plot_integral maths and the CSV report. The best
+wall time of --repeat runs is kept and the peak traced memory comes from one extra run under
+tracemalloc. The results are printed and written to JSON, so versions can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from absorbance_core import (ScanStore, apply_regions, get_file_info, list_scan_files, load_run, parse_file,
+                             update_cell_integrals, write_report)
+
+SCALES = {
+    "small": dict(cells=2, wavelengths=4, scans=10, points=400),
+    "medium": dict(cells=8, wavelengths=10, scans=20, points=800),
+    "large": dict(cells=8, wavelengths=25, scans=50, points=1600),
+}
+REGION = [5.95, 7.05]
+
+
+def write_run(directory: str, run_id: str = "BENCH", cells: int = 2, wavelengths: int = 4, scans: int = 10,
+              points: int = 400, seed: int = 0):
+    # scans of a CsCl gradient: a band whose height follows the wavelength, meniscus and bottom spikes
+    # outside REGION, noisy radii from 5.75 to 7.25 cm; names and layout as written by the instrument
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    wavelength_list = np.linspace(230, 600, wavelengths).astype(int)
+    for cell in range(1, cells + 1):
+        center = 6.3 + 0.05 * cell
+        for wavelength in wavelength_list.tolist():
+            height = 0.2 + np.exp(-((wavelength - 260) / 40) ** 2)
+            for scan in range(1, scans + 1):
+                x_vals = np.sort(np.linspace(5.75, 7.25, points) + rng.normal(0, 2e-4, points))
+                y_vals = height * np.exp(-((x_vals - center) / 0.15) ** 2) + rng.normal(0, 0.01, points)
+                y_vals[x_vals < 5.9] += 2.0
+                y_vals[x_vals > 7.1] += 2.5
+                std_vals = np.abs(rng.normal(0.002, 0.0005, points))
+                f_name = f"{run_id}-x-c{cell}-s{scan:04d}-w{wavelength:03d}-x-x.ra1"
+                with open(os.path.join(directory, f_name), "w") as fid:
+                    fid.write(f"Synthetic absorbance scan\nR {cell} 20.0 42000 {scan * 60} {wavelength} 1\n")
+                    np.savetxt(fid, np.column_stack([x_vals, y_vals, std_vals]), fmt="%.4f %.5f %.5f")
+
+
+def measure(func, setup=None, repeat: int = 3):
+    # best wall time of "repeat" calls, then the peak traced memory of one more call
+    best = None
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    args = setup() if setup is not None else ()
+    tracemalloc.start()
+    try:
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def run_benchmark(directory: str, n_workers: int = None, repeat: int = 3):
+    file_list = list_scan_files(directory)
+    n_scans = len(file_list)
+    parsed = []
+    stages = dict()
+
+    def add_stage(name, func, setup=None):
+        seconds, peak = measure(func, setup, repeat)
+        stages[name] = {"seconds": seconds, "scans_per_s": n_scans / seconds if seconds > 0 else None,
+                        "peak_bytes": peak}
+
+    def parse_all():
+        parsed[:] = [(get_file_info(os.path.split(fpath)[1]), parse_file(fpath)) for fpath in file_list]
+
+    add_stage("parse_file", parse_all)
+    infos, xy_list = zip(*parsed)
+    _, cells, scans, wavelengths = zip(*infos)
+    x_list, y_list = zip(*xy_list)
+
+    def index(store):
+        store.append(cells, scans, wavelengths, x_list, y_list)
+
+    add_stage("load_data", index, lambda: (ScanStore(),))
+    add_stage("load_run", lambda: load_run(directory, n_workers, use_cache=False))
+
+    store = ScanStore()
+    index(store)
+    cell_minmax = {cell: REGION for cell in store.cells().tolist()}
+    add_stage("apply_region", lambda: apply_regions(store, cell_minmax))
+
+    def dirty_store():
+        store.dirty[:] = True
+        return store, cell_minmax, dict()
+
+    add_stage("plot_integral", update_cell_integrals, dirty_store)
+    cell_integral = dict()
+    update_cell_integrals(store, cell_minmax, cell_integral)
+    report_name = os.path.join(directory, "benchmark_report.csv")
+    add_stage("report", lambda: write_report(report_name, cell_integral))
+    os.remove(report_name)
+    return {"scans": n_scans, "points": int(np.sum(store.sizes)), "stages": stages}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the absorbance pipeline on synthetic runs.")
+    parser.add_argument("-s", "--scales", nargs="+", default=["small", "medium"], choices=list(SCALES),
+                        help="run sizes to benchmark")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="JSON file of the results")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of parser processes of load_run")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="timed calls per stage, the best is kept")
+    parser.add_argument("--keep", default=None, metavar="DIR",
+                        help="write the synthetic runs to DIR/<scale> and keep them")
+    args = parser.parse_args(argv)
+
+    results = dict()
+    for scale in args.scales:
+        if args.keep is not None:
+            directory = os.path.join(args.keep, scale)
+            if len(list_scan_files(directory)) == 0:
+                write_run(directory, **SCALES[scale])
+            results[scale] = run_benchmark(directory, args.jobs, args.repeat)
+        else:
+            with tempfile.TemporaryDirectory() as directory:
+                write_run(directory, **SCALES[scale])
+                results[scale] = run_benchmark(directory, args.jobs, args.repeat)
+        result = results[scale]
+        print(f"{scale}: {result['scans']} scans, {result['points']} points")
+        for name, stage in result["stages"].items():
+            print(f"  {name:<14}{stage['seconds'] * 1e3:10.2f} ms{stage['scans_per_s']:12.0f} scans/s"
+                  f"{stage['peak_bytes'] / 2 ** 20:10.2f} MB")
+
+    summary = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scales": {scale: SCALES[scale] for scale in args.scales},
+        "results": results,
+    }
+    with open(args.output, "w") as fid:
+        json.dump(summary, fid, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+import tracemalloc
+import numpy as np
+import pytest
+from absorbance_core import (ScanStore, apply_regions, find_outliers, load_run, open_run, scan_table,
+                             update_cell_integrals)
+from benchmark import REGION, write_run
+
+
+def gaussian_store(n_groups: int, n_scans: int, seed: int = 0):
+    # clean scans of one band with white noise, n_scans per (cell, wavelength) group
+    rng = np.random.default_rng(seed)
+    cells, scans, wavelengths, x_list, y_list = [], [], [], [], []
+    for group in range(n_groups):
+        for scan in range(1, n_scans + 1):
+            x_vals = np.sort(np.linspace(5.9, 7.0, 300) + rng.normal(0, 2e-4, 300))
+            y_vals = np.exp(-((x_vals - 6.4) / 0.1) ** 2) + rng.normal(0, 0.01, 300)
+            cells.append(1 + group // 10)
+            scans.append(scan)
+            wavelengths.append(250 + group % 10)
+            x_list.append(x_vals.astype(np.float32))
+            y_list.append(y_vals.astype(np.float32))
+    store = ScanStore()
+    store.append(cells, scans, wavelengths, x_list, y_list)
+    return store
+
+
+@pytest.mark.parametrize("n_scans", [4, 6, 12])
+def test_clean_groups_keep_their_scans(n_scans):
+    store = gaussian_store(100, n_scans, seed=n_scans)
+    assert len(find_outliers(store)[0]) == 0
+    assert len(find_outliers(store, profiles=True)[0]) == 0
+
+
+@pytest.mark.parametrize("n_scans", [4, 6])
+def test_clean_run_keeps_its_scans(tmp_path, n_scans):
+    write_run(str(tmp_path), cells=4, wavelengths=10, scans=n_scans, points=400, seed=n_scans)
+    _, store = load_run(str(tmp_path), 1, use_cache=False)
+    apply_regions(store, {cell: REGION for cell in store.cells().tolist()})
+    assert len(find_outliers(store, profiles=True)[0]) == 0
+
+
+def test_shifted_scan_is_an_outlier():
+    store = gaussian_store(1, 6)
+    abs_id = store.group_scans(0)[2]
+    store.y_data[store.offsets[abs_id]: store.offsets[abs_id] + store.sizes[abs_id]] += 0.02
+    store.add_areas(0)
+    assert find_outliers(store)[0].tolist() == [abs_id]
+
+
+def test_lazy_store_keeps_within_its_memory_limit(tmp_path):
+    write_run(str(tmp_path), cells=2, wavelengths=10, scans=20, points=1600)
+    memory_limit = 2 * 2 ** 20
+    _, store = open_run(str(tmp_path), memory_limit, 1)
+    cell_minmax = {cell: REGION for cell in store.cells().tolist()}
+    _, in_memory = load_run(str(tmp_path), 1, use_cache=False)
+    apply_regions(in_memory, cell_minmax)
+    assert int(np.sum(in_memory.sizes)) * 16 > 4 * memory_limit
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        apply_regions(store, cell_minmax)
+        cell_integral = dict()
+        update_cell_integrals(store, cell_minmax, cell_integral)
+        for group in range(0, len(store.group_cell), 3):
+            store.load(store.group_scans(group))
+        table = scan_table(store, cell_minmax)
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    assert len(store.x_buffer) * 16 <= memory_limit
+    assert peak < 2 * memory_limit
+    assert np.allclose(table["area"], scan_table(in_memory, cell_minmax)["area"], rtol=0, atol=1e-9)